@@ -0,0 +1,304 @@
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2 as cv
+import numpy as np
+import pytesseract
+
+from main import GameAutomation
+from utils.frame_store import decode_png
+from utils.screen_state import CLOSE_BATTLE_TEMPLATE, IN_BATTLE_TEMPLATE
+from utils.session import SessionWriter
+from utils.get_image_path import get_image_path
+
+REPO_ROOT = os.path.join(os.path.dirname(__file__), '..')
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'benchmark_baseline.json')
+SCREENSHOTS = ['number_screencap.png', 'debug_number_screenshot.png']
+
+# A stage regresses when its p50 grows by more than this fraction over the baseline
+DEFAULT_THRESHOLD = 0.5
+# Allocation peaks below this are noise from the interpreter itself
+ALLOCATION_SLACK_KIB = 64
+# Likewise for time: sub-millisecond stages move by more than the threshold from scheduling alone
+TIME_SLACK_MS = 0.5
+
+
+def summarize(samples, peak_bytes):
+    milliseconds = np.array(samples) * 1000
+    return {
+        'iterations': len(samples),
+        'mean_ms': float(milliseconds.mean()),
+        'p50_ms': float(np.percentile(milliseconds, 50)),
+        'p95_ms': float(np.percentile(milliseconds, 95)),
+        'p99_ms': float(np.percentile(milliseconds, 99)),
+        'alloc_peak_kib': peak_bytes / 1024,
+    }
+
+
+def measure(function, iterations, setup=None, allocation_iterations=3):
+    samples = []
+    for _ in range(iterations):
+        if setup:
+            setup()
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+
+    # Allocations are traced in a separate pass so tracemalloc's overhead stays out of the timings
+    tracemalloc.start()
+    peak = 0
+    for _ in range(allocation_iterations):
+        if setup:
+            setup()
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        function()
+        peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    tracemalloc.stop()
+    return summarize(samples, peak)
+
+
+def load_screenshots():
+    encoded, images = [], []
+    for name in SCREENSHOTS:
+        with open(os.path.join(REPO_ROOT, name), 'rb') as f:
+            data = f.read()
+        encoded.append(data)
+        images.append(decode_png(data))
+    return encoded, images
+
+
+def create_bot(**options):
+    return GameAutomation(headless=True, log_file=os.devnull, **options)
+
+
+def bench_decode(iterations, encoded, images):
+    return {'png_decode': measure(lambda: decode_png(encoded[0]), iterations)}
+
+
+def bench_analyze(iterations, encoded, images):
+    bot = create_bot()
+    results = {}
+    for name in bot.templates.names():
+        frames = iter(range(sys.maxsize))
+
+        # Alternating screenshots keeps the change tracker from skipping the match
+        def publish():
+            bot.publish_frame(images[next(frames) % len(images)], 'BGR')
+
+        results[f"analyze_image[{name}]"] = measure(lambda: bot.analyze_image(name), iterations, setup=publish)
+    return results
+
+
+def tesseract_available():
+    try:
+        pytesseract.get_tesseract_version()
+    except pytesseract.TesseractNotFoundError:
+        return False
+    return True
+
+
+def bench_ocr(iterations, encoded, images):
+    bot = create_bot()
+    frame = bot.publish_frame(images[0], 'BGR')
+    regions = {
+        'gold': bot.gold_region,
+        'cost_of_production': bot.cost_of_production_region,
+        'gold_won_on_battle': bot.gold_won_on_battle_region,
+        'evolve_amount': bot.evolve_amount_region,
+    }
+    results = {}
+    for name, region in regions.items():
+        # Regions the glyph OCR cannot read fall back to Tesseract; without it installed the
+        # stage would only time the TesseractNotFoundError and say nothing about a real host
+        x1, y1, x2, y2 = region
+        if bot.digit_ocr.read(frame.gray[y1:y2, x1:x2])[0] is None and not tesseract_available():
+            print(f"Skipping read_number_from_screen[{name}]: needs Tesseract, which is not installed")
+            continue
+        # A cold cache, otherwise every call after the first is a lookup
+        results[f"read_number_from_screen[{name}]"] = measure(
+            lambda: bot.read_number_from_screen(region, frame=frame), iterations, setup=bot.ocr_cache.clear)
+    return results
+
+
+def bench_stuck(iterations, encoded, images):
+    bot = create_bot()
+    gray = cv.cvtColor(images[0], cv.COLOR_BGR2GRAY)
+    timestamps = iter(range(sys.maxsize))
+    for _ in range(bot.stuck_detector.min_frames):
+        bot.stuck_detector.update(gray, next(timestamps) * 0.05)
+
+    def check():
+        bot.stuck_detector.update(gray, next(timestamps) * 0.05)
+        bot.check_if_stuck()
+
+    return {'check_if_stuck': measure(check, iterations)}
+
+
+def paste(image, template_name, x, y):
+    template = cv.imread(get_image_path(template_name), cv.IMREAD_COLOR)
+    composite = image.copy()
+    composite[y:y + template.shape[0], x:x + template.shape[1]] = template
+    return composite
+
+
+def write_battle_cycle_session(path, menu):
+    # Battle, then the result screen, the menu and the next battle, built on a real screenshot
+    battle = paste(menu, IN_BATTLE_TEMPLATE, 40, 160)
+    result = paste(menu, CLOSE_BATTLE_TEMPLATE, 490, 1500)
+    menu = paste(menu, 'start-battle-button.png', 436, 1600)
+    writer = SessionWriter(path, metadata={'serial': 'benchmark'})
+    timestamp = 0.0
+    for image, count in ((battle, 20), (result, 5), (menu, 10), (battle, 10)):
+        for _ in range(count):
+            writer.write_frame(image, timestamp)
+            timestamp += 0.05
+    writer.close()
+
+
+def replay_bot(session_path):
+    # Raw capture, so the fake device does not spend the cycle PNG-encoding every replayed frame
+    bot = create_bot(replay_session=session_path, capture_backend='raw', should_upgrade_production=False)
+    bot.initialize()
+    # Encode every replayed frame up front, so neither the timings nor the allocations include the fake device
+    for _ in bot.device.frames:
+        bot.device.screencap_raw()
+    bot.device.frame_index = 0
+    return bot
+
+
+def cycle_transitions(bot):
+    return [(previous, state) for _, previous, state, _ in bot.state_machine.transitions]
+
+
+def completed_cycle(bot):
+    transitions = cycle_transitions(bot)
+    return ('battle_result', 'menu') in transitions and ('menu', 'battle') in transitions
+
+
+def run_battle_cycle(bot):
+    # Replays advance one frame per capture on the recording's clock, so driving the loop here takes
+    # the same path on every run and ends with the recording at the latest, it cannot time out
+    while not completed_cycle(bot) and not bot.device.finished:
+        bot.run_iteration()
+
+
+def stop_bot(bot):
+    bot.running = False
+    bot.shutdown()
+
+
+def bench_battle_cycle(iterations, encoded, images):
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'battle_cycle.session')
+        write_battle_cycle_session(path, images[1])
+        bots = []
+
+        # Loading the session, starting the bot and stopping the previous one stay out of the timed part
+        def setup():
+            if bots:
+                stop_bot(bots.pop())
+            bots.append(replay_bot(path))
+
+        # Each cycle replays dozens of frames, a handful of runs is enough
+        result = measure(lambda: run_battle_cycle(bots[-1]), max(3, iterations // 10), setup=setup,
+                         allocation_iterations=1)
+        bot = bots.pop()
+        if not completed_cycle(bot):
+            print(f"Warning: the replayed battle cycle did not get back to battle: {cycle_transitions(bot)}")
+        stop_bot(bot)
+        return {'replayed_battle_cycle': result}
+
+
+STAGES = {
+    'decode': bench_decode,
+    'analyze': bench_analyze,
+    'ocr': bench_ocr,
+    'stuck': bench_stuck,
+    'battle_cycle': bench_battle_cycle,
+}
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    for name, stage in results['stages'].items():
+        reference = baseline['stages'].get(name)
+        if reference is None:
+            continue
+        stage_threshold = baseline.get('thresholds', {}).get(name, threshold)
+        if stage['p50_ms'] > reference['p50_ms'] * (1 + stage_threshold) + TIME_SLACK_MS:
+            regressions.append(f"{name}: p50 {stage['p50_ms']:.3f} ms vs baseline {reference['p50_ms']:.3f} ms")
+        allowed_kib = reference['alloc_peak_kib'] * (1 + stage_threshold) + ALLOCATION_SLACK_KIB
+        if stage['alloc_peak_kib'] > allowed_kib:
+            regressions.append(f"{name}: peak allocations {stage['alloc_peak_kib']:.0f} KiB "
+                               f"vs baseline {reference['alloc_peak_kib']:.0f} KiB")
+    return regressions
+
+
+def print_results(results):
+    print(f"{'stage':<48} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'peak KiB':>9}")
+    for name, stage in results['stages'].items():
+        print(f"{name:<48} {stage['p50_ms']:>9.3f} {stage['p95_ms']:>9.3f} {stage['p99_ms']:>9.3f} "
+              f"{stage['alloc_peak_kib']:>9.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time each hot path of the bot against the repo fixtures")
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--stages', nargs='+', choices=sorted(STAGES), default=list(STAGES))
+    parser.add_argument('--output', help="Write the results to this JSON file")
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE, help="Results to compare against")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="Allowed fractional slowdown of a stage's p50 over the baseline")
+    parser.add_argument('--update-baseline', action='store_true', help="Store these results as the new baseline")
+    args = parser.parse_args()
+
+    encoded, images = load_screenshots()
+    results = {
+        'created': time.time(),
+        'python': platform.python_version(),
+        'opencv': cv.__version__,
+        'machine': platform.machine(),
+        'stages': {},
+    }
+    for stage in args.stages:
+        results['stages'].update(STAGES[stage](args.iterations, encoded, images))
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline:
+        # Per-stage thresholds are configuration, they survive a baseline refresh
+        results['thresholds'] = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                results['thresholds'] = json.load(f).get('thresholds', {})
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Saved baseline to {args.baseline}")
+        return
+
+    if not os.path.exists(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --update-baseline to create one")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+    print(f"No stage regressed more than {args.threshold:.0%} against {args.baseline}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+import cv2 as cv
+import numpy as np
+from ppadb.client import Client as AdbClient
+
+from utils.capture import create_capture_backend
+from utils.fake_adb_server import FakeAdbServer
+from utils.fake_device import FakeDevice, write_test_video
+
+REPO_ROOT = os.path.join(os.path.dirname(__file__), '..')
+SCREENSHOTS = ['debug_number_screenshot.png', 'number_screencap.png']
+
+# Mean absolute difference from the source screenshot a decoded frame may have after lossy encoding
+MAX_MEAN_DIFF = 12.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a generated video through the screenrecord capture backend")
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--scale', type=float, default=0.5, help="Resolution the fake device encodes at")
+    args = parser.parse_args()
+
+    frames = [cv.imread(os.path.join(REPO_ROOT, name), cv.IMREAD_COLOR) for name in SCREENSHOTS]
+    encoded = [cv.resize(frame, None, fx=args.scale, fy=args.scale, interpolation=cv.INTER_AREA) for frame in frames]
+
+    with tempfile.TemporaryDirectory() as directory:
+        video_path = write_test_video(encoded, os.path.join(directory, 'screenrecord'))
+        device = FakeDevice.with_video(frames, video_path)
+        print(f"Serving {os.path.basename(video_path)} ({os.path.getsize(video_path) / 1024:.0f} KiB)")
+
+        # Through the adb protocol, so the stream is read from a real ppadb socket
+        server = FakeAdbServer(device).start()
+        adb_device = AdbClient(host='127.0.0.1', port=server.port).devices()[0]
+        capture = create_capture_backend('screenrecord', adb_device, scale=args.scale)
+
+        diffs, timings = [], []
+        deadline = time.monotonic() + args.seconds
+        try:
+            while time.monotonic() < deadline:
+                start = time.perf_counter()
+                image, _ = capture.capture()
+                timings.append(time.perf_counter() - start)
+                if image.shape != frames[0].shape:
+                    print(f"Frame has shape {image.shape}, expected {frames[0].shape}")
+                    sys.exit(1)
+                diffs.append(min(cv.norm(image, frame, cv.NORM_L1) / image.size for frame in frames))
+        finally:
+            capture.close()
+            server.stop()
+
+    print(f"{capture.frames_decoded} frames decoded, {len(timings)} captures, "
+          f"mean capture {1000 * np.mean(timings):.1f} ms, {capture.restarts} stream restarts")
+    print(f"Mean difference from the source screenshots: {np.mean(diffs):.2f} (max {max(diffs):.2f})")
+    commands = [request for _, request in server.requests if 'screenrecord' in request]
+    print(f"Last command: {commands[-1] if commands else None}")
+
+    if not capture.frames_decoded or not capture.restarts or max(diffs) > MAX_MEAN_DIFF:
+        print("FAILED")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
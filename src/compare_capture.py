@@ -0,0 +1,42 @@
+import argparse
+import glob
+import os
+
+from ppadb.client import Client as AdbClient
+from utils.capture import compare_capture_backends
+from utils.fake_device import FakeDevice
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the capture backends")
+    parser.add_argument('--raw-dumps', nargs='*', help="Serve these raw screencap dumps from a fake device instead of a real one")
+    parser.add_argument('--images', nargs='*', help="Serve these PNG screenshots from a fake device instead of a real one")
+    parser.add_argument('--iterations', type=int, default=20)
+    args = parser.parse_args()
+
+    if args.raw_dumps:
+        device = FakeDevice.from_raw_dumps(args.raw_dumps)
+    elif args.images:
+        device = FakeDevice.from_images(args.images)
+    else:
+        try:
+            devices = AdbClient(host="127.0.0.1", port=5037).devices()
+        except RuntimeError:
+            devices = []
+
+        if not devices:
+            repo_root = os.path.join(os.path.dirname(__file__), '..')
+            device = FakeDevice.from_images(glob.glob(os.path.join(repo_root, '*screen*.png')))
+        else:
+            device = devices[0]
+
+    for name, result in compare_capture_backends(device, args.iterations).items():
+        if 'error' in result:
+            print(f"{name}: {result['error']}")
+            continue
+        print(f"{name}: mean {result['mean_ms']:.1f} ms, min {result['min_ms']:.1f} ms, "
+              f"{result['shape']} {result['pixel_format']}")
+
+
+if __name__ == "__main__":
+    main()
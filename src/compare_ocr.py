@@ -0,0 +1,76 @@
+import argparse
+import os
+import time
+
+import cv2 as cv
+import pytesseract
+from PIL import Image
+
+from utils.digit_ocr import DEFAULT_ATLAS_PATH, GLYPH_LABELS, DigitOCR
+from utils.number_parsing import parse_number_text
+
+REPO_ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+# Saved crops with their known reading: (file, region or None, text). The bundled atlas is built
+# from these same crops, so reading them back only checks segmentation and matching, not how the
+# atlas does on unseen digits
+CORPUS = [
+    ('cropped_number.png', None, '591k'),
+    ('number_screencap.png', (80, 7, 300, 70), '591k'),
+    ('debug_number_screenshot.png', (80, 7, 300, 70), '2.83k'),
+]
+
+
+def load_corpus():
+    samples = []
+    for name, region, text in CORPUS:
+        image = cv.imread(os.path.join(REPO_ROOT, name), cv.IMREAD_GRAYSCALE)
+        if image is None:
+            continue
+        if region:
+            x1, y1, x2, y2 = region
+            image = image[y1:y2, x1:x2]
+        samples.append((name, image, text))
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the glyph atlas OCR against Tesseract on the saved crops")
+    parser.add_argument('--build-atlas', action='store_true', help="Rebuild the atlas from the corpus before comparing")
+    parser.add_argument('--iterations', type=int, default=5)
+    args = parser.parse_args()
+
+    samples = load_corpus()
+    if args.build_atlas:
+        ocr = DigitOCR(atlas_path=None)
+        for _, crop, text in samples:
+            ocr.learn(crop, text)
+        ocr.save(DEFAULT_ATLAS_PATH)
+        print(f"Saved {len(ocr.labels)} glyphs to {DEFAULT_ATLAS_PATH}")
+
+    ocr = DigitOCR()
+    missing = [label for label in GLYPH_LABELS if label not in ocr.labels]
+    print(f"Atlas has {len(ocr.labels)} glyphs covering {''.join(sorted(set(ocr.labels)))}; "
+          f"these crops are its training data, nothing here tests {' '.join(missing) or 'other glyphs'}")
+    for name, crop, text in samples:
+        expected = parse_number_text(text)
+
+        start = time.perf_counter()
+        for _ in range(args.iterations):
+            value, confidence = ocr.read(crop)
+        atlas_ms = 1000 * (time.perf_counter() - start) / args.iterations
+
+        try:
+            start = time.perf_counter()
+            tesseract_value = parse_number_text(pytesseract.image_to_string(Image.fromarray(crop), lang='eng'))
+            tesseract_ms = 1000 * (time.perf_counter() - start)
+            tesseract = f"{tesseract_value} {'ok' if tesseract_value == expected else 'WRONG'} {tesseract_ms:.1f} ms"
+        except pytesseract.TesseractNotFoundError:
+            tesseract = "not installed"
+
+        print(f"{name}: expected {expected}, atlas {value} {'ok' if value == expected else 'WRONG'} "
+              f"(confidence {confidence:.2f}) {atlas_ms:.2f} ms, tesseract {tesseract}")
+
+
+if __name__ == "__main__":
+    main()
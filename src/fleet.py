@@ -0,0 +1,166 @@
+import argparse
+import json
+import multiprocessing
+import re
+import threading
+import time
+from queue import Empty
+
+from ppadb.client import Client as AdbClient
+from utils.templates import TemplateRegistry
+
+STATUS_INTERVAL = 5.0
+RESTART_BACKOFF = (1.0, 60.0)
+
+
+def worker_main(serial, templates_block, templates_manifest, status_queue, config):
+    # Imported here so the supervisor itself never initialises curses
+    from main import GameAutomation
+
+    templates = TemplateRegistry.from_shared(templates_block, templates_manifest)
+    safe_serial = re.sub(r'[^0-9A-Za-z_.-]', '_', serial)
+    game = GameAutomation(serial=serial, headless=True, templates=templates, log_file=f'debug-{safe_serial}.log', **config)
+    if not game.initialize():
+        return
+
+    def report_status():
+        while game.running:
+            status_queue.put(game.status())
+            time.sleep(STATUS_INTERVAL)
+
+    threading.Thread(target=report_status, daemon=True).start()
+    game.run()
+
+
+class FleetSupervisor:
+    def __init__(self, config=None, adb_port=5037, device_configs=None):
+        # config applies to every device, device_configs maps a serial to the options it overrides
+        self.config = dict(config or {}, adb_port=adb_port)
+        self.device_configs = dict(device_configs or {})
+        self.client = AdbClient(host="127.0.0.1", port=adb_port)
+        self.status_queue = multiprocessing.Queue()
+        self.workers = {}
+        self.restarts = {}
+        self.next_start = {}
+        self.statuses = {}
+        self.templates_block = None
+        self.templates_manifest = None
+        self.started_at = time.time()
+
+    def start(self):
+        self.templates_block, self.templates_manifest = TemplateRegistry.load().export_shared()
+        self.discover()
+        return len(self.workers)
+
+    def connected_serials(self):
+        try:
+            return {device.serial for device in self.client.devices()}
+        except RuntimeError as e:
+            # adb restarting or briefly unreachable, the workers carry on and the next poll retries
+            print(f"Could not list devices: {e}")
+            return None
+
+    def discover(self):
+        # Polled on every status interval, so a device plugged in after startup gets a worker too
+        connected = self.connected_serials()
+        if connected is None:
+            return None
+        for serial in sorted(connected - set(self.workers)):
+            print(f"Starting worker for {serial}")
+            self.start_worker(serial)
+        return connected
+
+    def config_for(self, serial):
+        return dict(self.config, **self.device_configs.get(serial, {}))
+
+    def start_worker(self, serial):
+        process = multiprocessing.Process(
+            target=worker_main,
+            args=(serial, self.templates_block.name, self.templates_manifest, self.status_queue,
+                  self.config_for(serial)),
+            name=f"worker-{serial}",
+            daemon=True,
+        )
+        process.start()
+        self.workers[serial] = process
+
+    def supervise(self, connected=None):
+        now = time.time()
+        for serial, process in list(self.workers.items()):
+            if process.is_alive() or now < self.next_start.get(serial, 0):
+                continue
+            # A detached device is left alone until it shows up again
+            if connected is not None and serial not in connected:
+                continue
+
+            # Exponential backoff so a device that crashes on start doesn't spin
+            restarts = self.restarts.get(serial, 0)
+            if serial in self.next_start:
+                print(f"Restarting worker for {serial} (exit code {process.exitcode}, restart {restarts + 1})")
+                self.restarts[serial] = restarts + 1
+                del self.next_start[serial]
+                self.start_worker(serial)
+            else:
+                self.next_start[serial] = now + min(RESTART_BACKOFF[1], RESTART_BACKOFF[0] * 2 ** restarts)
+
+    def collect_statuses(self):
+        while True:
+            try:
+                status = self.status_queue.get_nowait()
+            except Empty:
+                return
+            self.statuses[status['serial']] = status
+
+    def summary(self):
+        hours = (time.time() - self.started_at) / 3600
+        total_gold = sum(status['total_gold_won'] for status in self.statuses.values())
+        battles = sum(status['battles_completed'] for status in self.statuses.values())
+        alive = sum(process.is_alive() for process in self.workers.values())
+        gold_per_hour = total_gold / hours if hours else 0.0
+        return (f"{alive}/{len(self.workers)} workers alive, {battles} battles, "
+                f"{total_gold:,.0f} gold won, {gold_per_hour:,.0f} gold/hour")
+
+    def run(self):
+        if not self.start():
+            print("No devices connected yet, waiting for one")
+
+        try:
+            while True:
+                time.sleep(STATUS_INTERVAL)
+                self.collect_statuses()
+                self.supervise(self.discover())
+                print(self.summary())
+        except KeyboardInterrupt:
+            print("Stopping fleet...")
+        finally:
+            for process in self.workers.values():
+                process.terminate()
+            self.templates_block.close()
+            self.templates_block.unlink()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run one bot worker per connected device")
+    parser.add_argument('--unit', type=int, default=2, help="Unit to create (1-3)")
+    parser.add_argument('--capture-backend', default='png', choices=['png', 'raw', 'screenrecord'])
+    parser.add_argument('--input-driver', default='shell', choices=['shell', 'sendevent'])
+    parser.add_argument('--no-upgrade', action='store_true', help="Don't upgrade production")
+    parser.add_argument('--device-config', help="JSON file mapping device serials to the options they override, "
+                                                "e.g. {\"emulator-5554\": {\"unit_to_create\": 3}}")
+    args = parser.parse_args()
+
+    device_configs = {}
+    if args.device_config:
+        with open(args.device_config) as f:
+            device_configs = json.load(f)
+
+    FleetSupervisor(config={
+        'unit_to_create': args.unit,
+        'should_upgrade_production': not args.no_upgrade,
+        'capture_backend': args.capture_backend,
+        'input_driver': args.input_driver,
+    }, device_configs=device_configs).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,39 +1,112 @@
 from collections import deque
-import cv2 as cv
 import pytesseract
 import time
 import sys
 from ppadb.client import Client as AdbClient
-from utils.get_image_path import get_image_path
+from utils.templates import TemplateRegistry
+from utils.matcher import TemplateMatcher
+from utils.metrics import REGISTRY, MetricsExporter
+from utils.screen_state import (ScreenClassifier, BUY_COINS_TEMPLATE, CLOSE_BATTLE_TEMPLATE, IN_BATTLE_TEMPLATE,
+                                STUCK_TEMPLATE)
+from utils.session import RecordingDevice, ReplayDevice
+from utils.state_machine import InvalidTransition, ScreenStateMachine
+from utils.digit_ocr import DigitOCR
+from utils.number_parsing import parse_number_text
+from utils.ocr_cache import OCRCache
+from utils.stuck_detector import StuckDetector
+from utils.input_driver import create_input_driver
+from utils.tap_scheduler import TapScheduler
+from utils.async_device import AsyncDevice, BlockingDevice
+from utils.frame_store import FrameStore
+from utils.capture import create_capture_backend
+from utils.capture_scheduler import CaptureScheduler
+from utils.conditions import ScreenChangedAndSettled, ScreenSettled, wait_until
+from utils.log import setup_logging
+from utils.pipeline import AnalysisPipeline
 from datetime import datetime, timedelta
 import threading
 from PIL import Image, ImageEnhance
 import numpy as np
 import curses
-import re
 import cv2
 import logging
-import msvcrt
+
+try:
+    import msvcrt
+except ImportError:
+    # Only available on Windows, the console hotkeys are skipped elsewhere
+    msvcrt = None
+
+# Single text line, only the characters the HUD numbers are made of
+TESSERACT_NUMBER_CONFIG = '--psm 7 -c tessedit_char_whitelist=0123456789.kKmMbB'
 
 class GameAutomation:
-    def __init__(self, unit_to_create=2, should_upgrade_production=True):
-        self.client = AdbClient(host="127.0.0.1", port=5037)
+    def __init__(self, unit_to_create=2, should_upgrade_production=True, capture_backend='png', stuck_recovery_action=None,
+                 input_driver='shell', spawn_rate=8.0, spawn_pattern='selected', serial=None, headless=False,
+                 templates=None, log_file='debug.log', adb_port=5037, record_session=None, replay_session=None,
+                 metrics_file=None, metrics_interval=10.0, pipeline_workers=0, capture_options=None,
+                 learned_atlas=None):
+        self.client = AdbClient(host="127.0.0.1", port=adb_port)
         self.device = None
+        self.serial = serial
+        # Session files to record the device traffic to, or to play back instead of a device
+        self.record_session = record_session
+        self.replay_session = replay_session
+        # The replayed recording's clock; timeouts and timers run on it instead of the wall clock
+        self.virtual_clock = None
+        # Latency histograms and counters; exported to metrics_file (.json or Prometheus text) when set
+        self.metrics = REGISTRY
+        self.metrics_exporter = MetricsExporter(REGISTRY, metrics_file, metrics_interval) if metrics_file else None
+        self.metrics_snapshot = REGISTRY.snapshot()
+        self.metrics_rate_base = None
+        # Worker processes decoding and analysing captures in pipeline mode, 0 analyses on this process
+        self.pipeline_workers = pipeline_workers
+        self.pipeline = None
+        self.headless = headless
+        self.log_file = log_file
+        self.capture_backend_name = capture_backend
+        # Backend settings, e.g. {'scale': 0.5, 'bit_rate': 4000000} for the screenrecord stream
+        self.capture_options = capture_options or {}
+        self.capture = None
+        self.input_driver_name = input_driver
+        self.input = None
+        self.device_io = None
         self.loop_count = 0
         self.is_in_battle = False
         self.pause = False
         self.should_upgrade_production = should_upgrade_production
         self.screenshot_lock = threading.Lock()
-        self.screenshot_history = deque(maxlen=60)
-        self.stuck_threshold = 0.95
-        self.min_stuck_screenshots = 50
+        self.frame_store = FrameStore()
+        self.templates = templates or TemplateRegistry.load()
+        self.matcher = TemplateMatcher(self.templates)
+        self.classifier = ScreenClassifier(self.matcher)
+        self.state_machine = ScreenStateMachine(self.find_template, on_transition=self.on_state_transition,
+                                                clock=self.clock)
+        self.state_handlers = {
+            'unknown': self.handle_unknown_state,
+            'menu': self.handle_menu_state,
+            'upgrade_panel': self.handle_unknown_state,
+            'evolution_tab': self.handle_unknown_state,
+            'buy_coins_modal': self.handle_buy_coins_modal,
+            'battle': self.handle_battle_state,
+            'battle_result': self.exit_battle,
+            'stuck_dialog': self.handle_stuck_dialog,
+        }
+        # Tesseract fallbacks only teach the glyph OCR when a path for the learned atlas is given
+        self.digit_ocr = DigitOCR(learned_path=learned_atlas)
+        self.ocr_cache = OCRCache()
+        self.number_frame = None
+        self.stuck_detector = StuckDetector()
+        self.stuck_recovery_action = stuck_recovery_action or self.recover_from_stuck
         self.running = True
         self.gold_won_on_last_battle = 0
+        self.total_gold_won = 0
+        self.battles_completed = 0
         self.gold_held = 0
         self.gold_cost_of_next_upgrade = 0
         self.evolve_amount = 0
         self.key_handler_thread = None
-        self.screenshot_thread = None
+        self.capture_scheduler = CaptureScheduler(self.take_screenshot, self.frame_store)
         self.debug = False
         self.setup_logging()
         self.is_saving_to_evolve = False
@@ -63,9 +136,21 @@ class GameAutomation:
         self.cost_of_production_region = (800, 1245, 980, 1300)
         self.gold_won_on_battle_region = (360, 1000, 800, 1125)
         self.evolve_amount_region = (370, 1450, 700, 1530)
+        self.region_names = {
+            self.gold_region: 'gold',
+            self.cost_of_production_region: 'cost_of_production',
+            self.gold_won_on_battle_region: 'gold_won_on_battle',
+            self.evolve_amount_region: 'evolve_amount',
+        }
 
         self.time_of_start_of_battle = None
         self.start_to_create_units = False
+        self.battle_cycle_times = deque(maxlen=20)
+        self.last_battle_start = None
+        # Taps per second while spawning units in battle, 0 falls back to one tap per run() iteration
+        self.spawn_rate = spawn_rate
+        self.spawn_pattern = spawn_pattern
+        self.spawn_scheduler = None
 
         self.start_time = datetime.now()
 
@@ -80,23 +165,45 @@ class GameAutomation:
         self.screen = None
 
     def initialize(self):
-        devices = self.client.devices()
+        if self.replay_session:
+            devices = [ReplayDevice.load(self.replay_session)]
+        else:
+            devices = self.client.devices()
+        if self.serial:
+            devices = [device for device in devices if device.serial == self.serial]
         if len(devices) == 0:
             self.debug_print("No devices connected")
             return False
 
         self.device = devices[0]
-        self.setup_pause_handler()
+        if self.replay_session:
+            # Frames only advance when the bot asks for one and time only when a frame is served,
+            # so a replay makes the same decisions on every run however fast the host is
+            self.virtual_clock = self.device.clock
+            self.state_machine.set_clock(self.clock)
+            self.capture_scheduler.capture_on_demand_only()
+        if self.record_session:
+            self.device = RecordingDevice(self.device, self.record_session)
+        self.capture = create_capture_backend(self.capture_backend_name, self.device, **self.capture_options)
+        self.input = create_input_driver(self.input_driver_name, self.device)
+        self.device_io = BlockingDevice(AsyncDevice(self.device, self.capture, self.input))
+        self.spawn_scheduler = TapScheduler(self.input, self.spawn_targets, rate=self.spawn_rate or 1.0,
+                                            should_continue=self.should_keep_spawning)
+        if msvcrt and not self.headless:
+            self.setup_pause_handler()
+        frame = self.take_screenshot()
         self.is_in_battle = self.check_if_is_in_battle()
-        self.screenshot_thread = threading.Thread(target=self.screenshot_loop, daemon=True)
-        self.screenshot_thread.start()
-
-        self.screen = curses.initscr()
-        curses.noecho()
-        curses.cbreak()
-        self.screen.keypad(True)
-        curses.curs_set(0)
-        self.setup_ui_handler()
+        if self.pipeline_workers and frame is not None:
+            self.start_pipeline(frame.shape)
+        self.capture_scheduler.start()
+
+        if not self.headless:
+            self.screen = curses.initscr()
+            curses.noecho()
+            curses.cbreak()
+            self.screen.keypad(True)
+            curses.curs_set(0)
+            self.setup_ui_handler()
 
         self.debug_print("Bot started")
 
@@ -108,7 +215,7 @@ class GameAutomation:
                 if msvcrt.kbhit():
                     key = msvcrt.getch()
                     if key == b'p':
-                        self.pause = not self.pause
+                        self.toggle_pause()
                         print("Paused" if self.pause else "Resumed")
                     elif key == b'u':
                         self.should_upgrade_production = not self.should_upgrade_production
@@ -123,7 +230,7 @@ class GameAutomation:
                     elif key == b's':
                         print('Gold won on last battle:', self.gold_won_on_last_battle)
                     elif key == b'd':
-                        self.debug = not self.debug
+                        self.toggle_debug()
                         print(f"Debug mode {'enabled' if self.debug else 'disabled'}")
                     elif key == b'n':
                         self.debug_number_reading()
@@ -183,13 +290,29 @@ class GameAutomation:
         self.screen.addstr(status_y, 2, f"Gold held: {self.format_number(self.gold_held)}")
         self.screen.addstr(status_y + 1, 2, f"Gold won on last battle: {self.format_number(self.gold_won_on_last_battle)}")
         self.screen.addstr(status_y + 2, 2, f"Upgrade production cost: {self.format_number(self.gold_cost_of_next_upgrade)}")
-        self.screen.addstr(status_y + 3, 2, f"In battle: {'Yes' if self.is_in_battle else 'No'}")
+        self.screen.addstr(status_y + 3, 2, f"In battle: {'Yes' if self.is_in_battle else 'No'} "
+                                            f"(state: {self.state_machine.state}, "
+                                            f"{self.state_machine.templates_per_tick():.1f} templates/tick)")
         self.screen.addstr(status_y + 4, 2, f"Evolve amount: {self.format_number(self.evolve_amount)}")
         self.screen.addstr(status_y + 5, 2, f"Bot running time: {str(datetime.now() - self.start_time).split('.')[0]}")
         self.screen.addstr(status_y + 6, 2, f"Is saving to evolve: {'Yes' if self.is_saving_to_evolve else 'No'}")
+        self.screen.addstr(status_y + 7, 2, f"Template location hit rate: {self.format_location_hit_rate()}")
+        ocr_cache_stats = self.ocr_cache.stats()
+        self.screen.addstr(status_y + 8, 2, f"OCR cache: {ocr_cache_stats['hits']} hits, {ocr_cache_stats['misses']} misses")
+        capture_stats = self.capture_scheduler.stats()
+        capture_line = f"Capture: {capture_stats['mode']} {capture_stats['fps']:.1f} fps, {capture_stats['dropped']} dropped, {capture_stats['errors']} errors"
+        if self.pipeline:
+            pipeline_stats = self.pipeline.stats()
+            capture_line += (f", pipeline {pipeline_stats['workers']} workers, {pipeline_stats['in_flight']} in flight, "
+                             f"{pipeline_stats['stale']} stale")
+        self.screen.addstr(status_y + 9, 2, capture_line)
+        self.screen.addstr(status_y + 10, 2, f"Average battle cycle: {self.average_battle_cycle():.1f}s")
+        latency, throughput = self.format_metrics()
+        self.screen.addstr(status_y + 11, 2, f"Latency p50/p95 ms: {latency}")
+        self.screen.addstr(status_y + 12, 2, f"Throughput: {throughput}")
 
         # Hotkey information
-        hotkey_y = status_y + 9
+        hotkey_y = status_y + 14
         self.screen.addstr(hotkey_y, 2, "Hotkeys: (P)ause, (D)ebug, (U)pgrade, (Q)uit, (N)umber reading debug")
 
         self.screen.refresh()
@@ -222,193 +345,251 @@ class GameAutomation:
     def toggle_debug(self):
         self.debug = not self.debug
         self.menu_items[1] = (f"Debug Mode: {'ON' if self.debug else 'OFF'}", self.toggle_debug)
-        self.debug_print(f"Debug mode {'enabled' if self.debug else 'disabled'}")
+        self.logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
+        self.debug_print("Debug mode %s", 'enabled' if self.debug else 'disabled')
 
     def toggle_pause(self):
         self.pause = not self.pause
+        self.update_capture_mode()
         self.menu_items[2] = (f"Pause/Resume: {'Paused' if self.pause else 'Running'}", self.toggle_pause)
 
     def quit_program(self):
         self.running = False
-        curses.endwin()
+        if not self.headless:
+            curses.endwin()
         sys.exit(0)
 
-    def screenshot_loop(self):
-        while True:
-            self.take_screenshot()
-            time.sleep(0.02)
-
     def take_screenshot(self):
         if not self.device:
             self.debug_print("No device connected")
-            return
+            return None
 
-        image = self.device.screencap()
         try:
-            with open('./screencap.png', 'wb') as f:
-                f.write(image)
-            
-            # Convert the image to grayscale and add it to the history
-            gray_image = cv.imread('./screencap.png', cv.IMREAD_GRAYSCALE)
-            self.screenshot_history.append(gray_image)
-            
-        except IOError as e:
-            self.debug_print(f"Error writing screenshot: {e}")
-
-    def analyze_image(self, image_name):
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            with self.screenshot_lock:
+                with self.metrics.span('capture'):
+                    image, pixel_format = self.capture.capture()
+                return self.publish_frame(image, pixel_format)
+        except (RuntimeError, ValueError) as e:
+            self.debug_print("Error taking screenshot: %s", e)
+            return None
 
+    def start_pipeline(self, frame_shape):
+        ocr_regions = {name: region for region, name in self.region_names.items()}
+        self.pipeline = AnalysisPipeline(self.capture, self.templates, frame_shape, self.pipeline_workers,
+                                         ocr_regions, on_result=self.publish_analysis,
+                                         candidates=self.state_machine.candidates)
+        self.pipeline.start()
+        # Periodic and requested captures now only grab the screenshot, the workers do the rest
+        self.capture_scheduler.capture = self.pipeline.submit
+
+    def publish_analysis(self, image, gray, analysis):
+        return self.publish_frame(image, 'BGR', timestamp=analysis.timestamp, gray=gray, analysis=analysis)
+
+    def clock(self):
+        return self.virtual_clock() if self.virtual_clock else time.monotonic()
+
+    def publish_frame(self, image, pixel_format, **kwargs):
+        if self.virtual_clock:
+            kwargs.setdefault('timestamp', self.virtual_clock())
+        frame = self.frame_store.publish(image, pixel_format, **kwargs)
+        self.stuck_detector.update(frame.gray, frame.timestamp)
+        self.metrics.increment('frames')
+        return frame
+
+    def tap_and_capture(self, x, y):
         try:
-            mat = cv.imread('./screencap.png', cv.IMREAD_GRAYSCALE)
-            template = cv.imread(get_image_path(image_name), cv.IMREAD_GRAYSCALE)
-            result = cv.matchTemplate(mat, template, cv.TM_CCOEFF_NORMED)
-            _, max_val, _, max_loc = cv.minMaxLoc(result)
-
-            self.debug_print(f"[{current_time}] Analyzing image {image_name} - {max_val}")
+            image, pixel_format = self.device_io.tap_and_capture(x, y)
+            return self.publish_frame(image, pixel_format)
+        except (RuntimeError, ValueError) as e:
+            self.debug_print("Error in tap and capture: %s", e)
+            return None
 
-            match_threshold = 0.7
-            if max_val < match_threshold:
+    def analyze_image(self, image_name):
+        try:
+            frame = self.frame_store.consume()
+            if frame is None:
                 return None
 
-            center_x = max_loc[0] + template.shape[1] // 2
-            center_y = max_loc[1] + template.shape[0] // 2
+            center = self.find_template(frame, image_name)
 
-            return {'x': center_x, 'y': center_y}
+            self.debug_print("Analyzing image %s - %s", image_name, 'found' if center else 'not found')
+
+            return center
         except Exception as e:
-            self.debug_print(f"[{current_time}] Error analyzing image: {e}")
+            self.debug_print("Error analyzing image: %s", e)
             return None
 
+    def find_template(self, frame, name):
+        # Frames that went through the pipeline already carry their matches
+        analysis = frame.analysis if frame is not None else None
+        if analysis is not None and name in analysis.matches:
+            return analysis.matches[name]
+        # Timed here rather than in analyze_image, the state machine and wait_until predicates match
+        # through this too
+        with self.metrics.span('match_template', name):
+            return self.classifier.find(frame, name)
+
+    def on_state_transition(self, previous, state):
+        self.debug_print("State %s -> %s", previous, state)
+        self.is_in_battle = state == 'battle'
+        if state != 'battle':
+            # Only the thread: a missed battle detection on one frame must not end spawning for the
+            # rest of the battle, start_to_create_units is reset when the next battle starts
+            self.spawn_scheduler.stop()
+        self.update_capture_mode()
+
+    def update_capture_mode(self):
+        if self.pause:
+            self.capture_scheduler.set_mode('paused')
+        elif self.state_machine.state == 'battle_result':
+            self.capture_scheduler.set_mode('battle_end')
+        elif self.state_machine.state == 'battle':
+            self.capture_scheduler.set_mode('battle')
+        else:
+            self.capture_scheduler.set_mode('menu')
+
     def touch_screen(self, x, y):
         if not self.device:
             self.debug_print("No device connected")
             return
 
-        self.device.shell(f"input tap {x} {y}")
+        with self.metrics.span('touch_screen'):
+            self.input.tap(x, y)
+
+    def selected_troop(self):
+        troops = {1: self.first_troop, 2: self.second_troop, 3: self.third_troop}
+        if self.unit_to_create not in troops:
+            self.debug_print("Invalid troop number: %s. Creating default unit 2", self.unit_to_create)
+            return self.second_troop
+        return troops[self.unit_to_create]
 
     def create_unit(self):
-        if self.unit_to_create == 1:
-            self.debug_print("Creating unit 1")
-            self.touch_screen(self.first_troop['x'], self.first_troop['y'])
-        elif self.unit_to_create == 2:
-            self.debug_print("Creating unit 2")
-            self.touch_screen(self.second_troop['x'], self.second_troop['y'])
-        elif self.unit_to_create == 3:
-            self.debug_print("Creating unit 3")
-            self.touch_screen(self.third_troop['x'], self.third_troop['y'])
-        else:
-            self.debug_print(f"Invalid troop number: {self.unit_to_create}. Creating default unit 2")
-            self.touch_screen(self.second_troop['x'], self.second_troop['y'])
-            
+        self.debug_print("Creating unit %s", self.unit_to_create)
+        troop = self.selected_troop()
+        self.touch_screen(troop['x'], troop['y'])
 
-    def check_if_is_in_battle(self):
-        is_in_battle = self.analyze_image('is-in-battle.png')
-        return bool(is_in_battle)
+    def spawn_targets(self):
+        if self.spawn_pattern == 'rotate':
+            return [self.first_troop, self.second_troop, self.third_troop]
+        return [self.selected_troop()]
 
-    def check_if_is_on_menu(self):
-        is_on_menu = self.analyze_image('market-menu-button.png')
-        return bool(is_on_menu)
+    def should_keep_spawning(self):
+        # Reads the state machine only, the scheduler thread never runs the matcher itself
+        return (self.running and not self.pause and self.start_to_create_units
+                and self.state_machine.state == 'battle')
+
+    def check_if_is_in_battle(self):
+        return self.analyze_image(IN_BATTLE_TEMPLATE) is not None
 
     def handle_battle_state(self):
         if self.start_to_create_units:
-            self.create_unit()
+            # The scheduler taps on the wall clock, a replay spawns once per loop to stay repeatable
+            if self.spawn_rate > 0 and not self.virtual_clock:
+                self.spawn_scheduler.start()
+            else:
+                self.create_unit()
 
-        if self.time_of_start_of_battle and (datetime.now() - self.time_of_start_of_battle).total_seconds() > 7.5:
-            self.touch_screen(self.first_skill_coords['x'], self.first_skill_coords['y'])
-            self.touch_screen(self.second_skill_coords['x'], self.second_skill_coords['y'])
-            self.touch_screen(self.third_skill_coords['x'], self.third_skill_coords['y'])
-            self.touch_screen(self.hero_coords['x'], self.hero_coords['y'])
+        if self.time_of_start_of_battle and self.clock() - self.time_of_start_of_battle > 7.5:
+            with self.input.batch() as batch:
+                batch.tap(self.first_skill_coords['x'], self.first_skill_coords['y'])
+                batch.tap(self.second_skill_coords['x'], self.second_skill_coords['y'])
+                batch.tap(self.third_skill_coords['x'], self.third_skill_coords['y'])
+                batch.tap(self.hero_coords['x'], self.hero_coords['y'])
 
             self.time_of_start_of_battle = None
             self.start_to_create_units = True
 
-        close_battle_button = self.analyze_image('close-battle-button.png')
-        self.is_in_battle = self.check_if_is_in_battle()
-
-        if close_battle_button:
-            self.exit_battle()
-            self.is_in_battle = False
-
     def exit_battle(self):
-        close_battle_button = self.analyze_image('close-battle-button.png')
+        close_battle_button = self.analyze_image(CLOSE_BATTLE_TEMPLATE)
 
         if close_battle_button:
             self.gold_won_on_last_battle = self.read_number_from_screen(self.gold_won_on_battle_region, force_new_screenshot=True)
+            self.total_gold_won += self.gold_won_on_last_battle
+            self.battles_completed += 1
+            self.metrics.increment('battles')
+            self.metrics.increment('gold_won', self.gold_won_on_last_battle)
 
             self.touch_screen(close_battle_button['x'], close_battle_button['y'])
-            time.sleep(2)
+            self.wait_until(lambda frame: self.find_template(frame, CLOSE_BATTLE_TEMPLATE) is None, 2)
 
-        stuck_button = self.analyze_image('are-you-stuck-button.png')
+    def handle_stuck_dialog(self):
+        stuck_button = self.state_machine.last_matches.get(STUCK_TEMPLATE)
         if stuck_button:
             self.touch_screen(stuck_button['x'], stuck_button['y'])
 
-    def handle_menu_state(self):
-        stuck_button = self.analyze_image('are-you-stuck-button.png')
+    def handle_buy_coins_modal(self):
+        close_button = self.state_machine.last_matches.get(BUY_COINS_TEMPLATE)
+        if close_button:
+            self.touch_screen(close_button['x'], close_button['y'])
 
-        if stuck_button:
-            self.touch_screen(stuck_button['x'], stuck_button['y'])
+    def handle_unknown_state(self):
+        self.touch_screen(500, 1900)
 
+    def handle_menu_state(self):
         self.upgrade_and_start_battle()
 
+    def close_buy_coins_modal(self, return_state):
+        isBuyCoinsModal = self.analyze_image(BUY_COINS_TEMPLATE)
+
+        if isBuyCoinsModal:
+            self.state_machine.enter('buy_coins_modal', f"found {BUY_COINS_TEMPLATE}")
+            self.wait_until(ScreenSettled(), 0.3)
+            self.touch_screen(isBuyCoinsModal['x'], isBuyCoinsModal['y'])
+            self.state_machine.enter(return_state)
+
     def upgrade_and_start_battle(self):
-        time.sleep(0.5)
+        self.wait_until(ScreenSettled(), 0.5)
         self.gold_held = self.read_number_from_screen(self.gold_region, force_new_screenshot=True)
 
         if self.should_upgrade_production and (self.gold_held >= self.gold_cost_of_next_upgrade or self.gold_held == 0 or self.gold_cost_of_next_upgrade == 0 or self.gold_held >= self.evolve_amount):
-            self.touch_screen(self.upgrade_menu['x'], self.upgrade_menu['y'])
-
-            time.sleep(0.3)
-
-            self.touch_screen(self.evolution_tab_button['x'], self.evolution_tab_button['y'])
+            self.tap_and_wait_for_change(self.upgrade_menu, 1.0)
+            self.state_machine.enter('upgrade_panel')
 
-            time.sleep(0.1)
+            self.tap_and_wait_for_change(self.evolution_tab_button, 0.5, self.evolve_amount_region)
+            self.state_machine.enter('evolution_tab')
 
             self.evolve_amount = self.read_number_from_screen(self.evolve_amount_region, force_new_screenshot=True)
 
-            self.touch_screen(self.evolve_button['x'], self.evolve_button['y'])
-
-            time.sleep(0.3)
+            self.tap_and_wait_for_change(self.evolve_button, 1.0)
 
             self.touch_screen(500, 1900)
 
-            isBuyCoinsModal = self.analyze_image('close_buy_coins.png')
-
-            if isBuyCoinsModal:
-                time.sleep(0.3)
-                self.touch_screen(isBuyCoinsModal['x'], isBuyCoinsModal['y'])
-                isBuyCoinsModal = None
+            self.close_buy_coins_modal('evolution_tab')
 
-            time.sleep(0.1)
-
-            self.touch_screen(self.upgrade_tab_button['x'], self.upgrade_tab_button['y'])
+            self.wait_until(ScreenSettled(), 0.1)
 
-            time.sleep(0.1)
+            self.tap_and_wait_for_change(self.upgrade_tab_button, 0.5, self.cost_of_production_region)
+            self.state_machine.enter('upgrade_panel')
 
             self.gold_cost_of_next_upgrade = self.read_number_from_screen(self.cost_of_production_region, force_new_screenshot=True)
 
-            time.sleep(0.1)
             if (self.evolve_amount != 0 and self.gold_won_on_last_battle != 0 and self.evolve_amount / self.gold_won_on_last_battle > 20) or self.gold_cost_of_next_upgrade == 0:
+                # Held through a one-off shell on purpose: it returns once the 2 s hold is over
                 self.device.shell(f"input touchscreen swipe {self.upgrade_production['x']} {self.upgrade_production['y']} {self.upgrade_production['x']} {self.upgrade_production['y']} 2000")
 
-                isBuyCoinsModal = self.analyze_image('close_buy_coins.png')
-
-                if isBuyCoinsModal:
-                    time.sleep(0.3)
-                    self.touch_screen(isBuyCoinsModal['x'], isBuyCoinsModal['y'])
+                self.close_buy_coins_modal('upgrade_panel')
 
-                time.sleep(0.3)
+                self.wait_until(ScreenSettled(), 0.3)
                 self.is_saving_to_evolve = False
             else:
                 self.is_saving_to_evolve = True
 
-            self.gold_cost_of_next_upgrade = self.read_number_from_screen(self.cost_of_production_region, force_new_screenshot=True)
+            # Gold and the next cost are both on the upgrade tab, read them from one capture
+            numbers = self.read_numbers_from_screen({
+                'gold_held': self.gold_region,
+                'gold_cost_of_next_upgrade': self.cost_of_production_region,
+            })
+            self.gold_held = numbers['gold_held']
+            self.gold_cost_of_next_upgrade = numbers['gold_cost_of_next_upgrade']
         else:
             self.is_saving_to_evolve = True
 
         buttonToUse = None
 
-        start_time = time.time()
-        while not buttonToUse and time.time() - start_time < 10:
-            self.touch_screen(self.battle_menu['x'], self.battle_menu['y'])
+        start_time = self.clock()
+        while not buttonToUse and self.clock() - start_time < 10:
+            self.tap_and_capture(self.battle_menu['x'], self.battle_menu['y'])
+            self.state_machine.enter('menu')
             battle_button = self.analyze_image('start-battle-button.png')
             battle_brown_button = self.analyze_image('start-battle-brown-button.png')
 
@@ -422,115 +603,194 @@ class GameAutomation:
             self.debug_print("Could not find battle button")
             return
 
-        start_time = time.time()
-        while not self.is_in_battle and time.time() - start_time < 10:
+        start_time = self.clock()
+        while not self.is_in_battle and self.clock() - start_time < 10:
             self.touch_screen(buttonToUse['x'], buttonToUse['y'])
-            time.sleep(1)
+            self.wait_until(lambda frame: self.find_template(frame, IN_BATTLE_TEMPLATE) is not None, 1)
             self.is_in_battle = self.check_if_is_in_battle()
-            
-        self.time_of_start_of_battle = datetime.now()
-        self.start_to_create_units = False
-
-    def read_number_from_screen(self, region=None, force_new_screenshot=False):
-        try:
-            if force_new_screenshot:
-                self.take_number_screenshot()
-                time.sleep(0.1)  # Short delay to ensure the screenshot is saved
 
-            image = Image.open('./number_screencap.png')
-            image = image.convert('L')  # Convert to grayscale
+        if self.is_in_battle:
+            self.state_machine.enter('battle', f"found {IN_BATTLE_TEMPLATE}")
 
+        self.time_of_start_of_battle = self.clock()
+        self.start_to_create_units = False
+        self.record_battle_cycle()
+
+    def record_battle_cycle(self):
+        now = time.monotonic()
+        if self.last_battle_start is not None:
+            self.battle_cycle_times.append(now - self.last_battle_start)
+            self.logger.info("Battle cycle took %.1fs (average %.1fs over %d)", self.battle_cycle_times[-1],
+                             self.average_battle_cycle(), len(self.battle_cycle_times))
+        self.last_battle_start = now
+
+    def average_battle_cycle(self):
+        if not self.battle_cycle_times:
+            return 0.0
+        return sum(self.battle_cycle_times) / len(self.battle_cycle_times)
+
+    def wait_until(self, predicate, timeout):
+        # Returns the first new frame satisfying predicate, or None once timeout passes
+        if self.virtual_clock:
+            return wait_until(self.capture_scheduler.request_frame, predicate, timeout, self.frame_store.seq,
+                              clock=self.virtual_clock, request_timeout=1.0)
+        return wait_until(self.capture_scheduler.request_frame, predicate, timeout, self.frame_store.seq)
+
+    def tap_and_wait_for_change(self, coords, timeout, region=None):
+        # The reference is captured now, after the previous step's wait, so the tail of an earlier
+        # tap's animation can't pass for this tap's effect
+        reference = self.capture_scheduler.request_frame(self.frame_store.seq, 1.0)
+        changed = ScreenChangedAndSettled(reference, region)
+        self.touch_screen(coords['x'], coords['y'])
+        return self.wait_until(changed, timeout)
+
+    def read_number_from_screen(self, region=None, force_new_screenshot=False, frame=None):
+        try:
+            if frame is None:
+                frame = self.take_number_screenshot() if force_new_screenshot else self.number_frame
 
-            if region:
-                image = image.crop(region)
-                image.save('cropped_number.png')
-
-            text = pytesseract.image_to_string(image, lang='eng')
-
-            print(f"Raw Text: {text}")
-            logging.debug(f"Raw Text: {text}")
-
-            # Remove all non-alphanumeric characters except '.' and spaces
-            cleaned_text = re.sub(r'[^0-9a-zA-Z.\s]', '', text)
-
-            # Split the text into words
-            words = cleaned_text.split()
+            if frame is None:
+                return 0
 
-            # Find the first word that starts with a digit
-            number_word = next((word for word in words if word[0].isdigit()), None)
+            return self.read_number_from_frame(frame, region)
+        except Exception as e:
+            self.debug_print("Error in read_number_from_screen: %s", e)
+            return 0
 
-            if not number_word:
-                return 0
+    def read_numbers_from_screen(self, regions, force_new_screenshot=True):
+        frame = self.take_number_screenshot() if force_new_screenshot else self.number_frame
+        if frame is None:
+            return {name: 0 for name in regions}
+
+        # Tesseract runs as a subprocess and the glyph OCR is mostly OpenCV, so
+        # the regions can be read side by side on the device's analysis pool from the one frame
+        names = list(regions)
+        results = self.device_io.analyze_many([(self.read_number_from_frame, frame, regions[name])
+                                               for name in names])
+
+        numbers = {}
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                self.debug_print("Error reading %s from screen: %s", name, result)
+                result = 0
+            numbers[name] = result
+        return numbers
+
+    def read_number_from_frame(self, frame, region=None):
+        crop = frame.gray
+        if region:
+            x1, y1, x2, y2 = region
+            crop = crop[y1:y2, x1:x2]
+            if self.debug:
+                Image.fromarray(crop).save('cropped_number.png')
+
+        region_name = self.region_names.get(region, str(region))
+        numbers = frame.analysis.numbers if frame.analysis is not None else {}
+        if numbers.get(region_name) is not None:
+            return numbers[region_name]
+
+        with self.metrics.span('ocr', region_name):
+            cache_key = self.ocr_cache.key(region, crop)
+            amount = self.ocr_cache.get(cache_key)
+            if amount is not None:
+                return amount
+
+            amount = self.read_number_from_crop(crop)
+            self.ocr_cache.put(cache_key, amount)
+            return amount
 
-            # Extract only digits and decimal point
-            clean_digits = ''.join(filter(lambda x: x.isdigit() or x == '.', number_word))
+    def read_number_from_crop(self, crop):
+        amount, confidence = self.digit_ocr.read(crop)
+        if amount is not None:
+            self.debug_print("Glyph OCR amount: %s (confidence %.2f)", amount, confidence)
+            return amount
 
-            # Handle cases where the decimal point might be misread
-            if clean_digits.count('.') > 1:
-                clean_digits = clean_digits.replace('.', '', clean_digits.count('.') - 1)
+        text = pytesseract.image_to_string(Image.fromarray(crop), lang='eng')
+        amount = parse_number_text(text)
 
-            amount = float(clean_digits)
+        self.logger.info("Tesseract fallback read %s", amount,
+                         extra={'fields': {'text': text, 'glyph_confidence': round(confidence, 2)}})
 
-            print(f"Raw Text: {text}, Cleaned Text: {clean_digits}, Amount: {amount}")
-            logging.debug(f"Raw Text: {text}, Cleaned Text: {clean_digits}, Amount: {amount}")
+        if self.digit_ocr.learned_path and self.confirm_reading(crop, amount) and self.digit_ocr.learn(crop, text):
+            self.digit_ocr.save()
 
-            # Check for suffixes in the original text
-            lower_text = text.lower()
-            if 'm' in lower_text:
-                amount *= 1000000
-            elif 'b' in lower_text:
-                amount *= 1000000000
-            elif 'k' in lower_text:
-                amount *= 1000
+        return amount
 
-            return amount
-        except Exception as e:
-            self.debug_print(f"Error in read_number_from_screen: {e}")
-            return 0
+    def confirm_reading(self, crop, amount):
+        # A second pass restricted to the HUD characters has to agree before a reading is learned
+        text = pytesseract.image_to_string(Image.fromarray(crop), lang='eng', config=TESSERACT_NUMBER_CONFIG)
+        return amount != 0 and parse_number_text(text) == amount
 
     def take_number_screenshot(self):
-        if not self.device:
-            self.debug_print("No device connected")
-            return
-
-        image = self.device.screencap()
-        try:
-            with open('./number_screencap.png', 'wb') as f:
-                f.write(image)
-        except IOError as e:
-            self.debug_print(f"Error writing number screenshot: {e}")
+        # In pipeline mode the requested frame arrives with its numbers already read
+        frame = self.capture_scheduler.request_frame() if self.pipeline else self.take_screenshot()
+        if frame is not None:
+            self.number_frame = frame
+        return frame
 
     def check_if_stuck(self):
-        if len(self.screenshot_history) < self.min_stuck_screenshots:
+        if not self.stuck_detector.is_stuck():
             return False
 
-        reference = self.screenshot_history[-1]
-        similar_count = 0
-
-        for i in range(-2, -self.min_stuck_screenshots - 1, -1):
-            similarity = cv.matchTemplate(reference, self.screenshot_history[i], cv.TM_CCOEFF_NORMED)[0][0]
-            if similarity > self.stuck_threshold:
-                similar_count += 1
-            else:
-                break
+        self.logger.info("Detected stuck state (%d similar screenshots over %.1fs). Recovering.",
+                         self.stuck_detector.unchanged_frames + 1, self.stuck_detector.unchanged_seconds())
+        return True
 
-        if similar_count >= self.min_stuck_screenshots - 1:
-            self.debug_print(f"Detected stuck state ({similar_count + 1} similar screenshots). Restarting bot.")
-            return True
+    def recover_from_stuck(self):
+        stuck_button = self.analyze_image(STUCK_TEMPLATE)
+        if stuck_button:
+            self.touch_screen(stuck_button['x'], stuck_button['y'])
+        else:
+            self.touch_screen(500, 1900)
 
-        self.screenshot_history.clear()
+        self.stuck_detector.reset()
 
-        return False
+    def debug_print(self, message, *args, **kwargs):
+        # Arguments are only formatted by the log writer thread, and not at all while debug is off
+        self.logger.debug(message, *args, **kwargs)
 
-    def debug_print(self, message):
-        if self.debug:
-            logging.debug(message)
+    def status(self):
+        hours = (datetime.now() - self.start_time).total_seconds() / 3600
+        return {
+            'serial': self.device.serial if self.device else self.serial,
+            'gold_held': self.gold_held,
+            'total_gold_won': self.total_gold_won,
+            'battles_completed': self.battles_completed,
+            'gold_per_hour': self.total_gold_won / hours if hours else 0.0,
+            'is_in_battle': self.is_in_battle,
+            'loop_count': self.loop_count,
+        }
 
     def format_number(self, number):
         return f"{number:,.2f}"
 
+    def format_metrics(self):
+        snapshot = self.metrics.snapshot()
+        # Rates are taken over the last 10-20 seconds, so they neither jump around nor lag far behind
+        if snapshot.timestamp - self.metrics_snapshot.timestamp >= 10:
+            self.metrics_rate_base, self.metrics_snapshot = self.metrics_snapshot, snapshot
+        base = self.metrics_rate_base or self.metrics_snapshot
+
+        spans = [('capture', 'capture'), ('match', 'match_template'), ('ocr', 'ocr'), ('tap', 'touch_screen'),
+                 ('loop', 'run_iteration')]
+        latency = ', '.join(f"{label} {snapshot.histogram(name).percentile(0.5):g}/"
+                            f"{snapshot.histogram(name).percentile(0.95):g}" for label, name in spans)
+        throughput = (f"{snapshot.rate('frames', base):.1f} fps, {snapshot.rate('taps', base):.1f} taps/s, "
+                      f"{snapshot.rate('battles') * 3600:.1f} battles/h, "
+                      f"{self.format_number(snapshot.rate('gold_won') * 3600)} gold/h")
+        return latency, throughput
+
+    def format_location_hit_rate(self):
+        stats = self.matcher.stats_summary().values()
+        window_hits = sum(s['window_hits'] for s in stats)
+        lookups = window_hits + sum(s['region_hits'] for s in stats)
+        misses = sum(s['misses'] for s in stats)
+        rate = window_hits / lookups if lookups else 0.0
+        return f"{rate:.0%} ({window_hits}/{lookups} hits, {misses} misses)"
+
     def debug_number_reading(self):
         self.pause = True
+        self.capture_scheduler.set_mode('paused')
         selected_option = 0
         options = [
             ("Gold Held", self.gold_region),
@@ -563,10 +823,12 @@ class GameAutomation:
 
     def debug_selected_number(self, label, region):
         self.screen.clear()
-        self.take_number_screenshot()
-        number = self.read_number_from_screen(region)
-        
-        image = cv2.imread('./number_screencap.png')
+        frame = self.take_number_screenshot()
+        if frame is None:
+            return
+        number = self.read_number_from_screen(region, frame=frame)
+
+        image = frame.bgr.copy()
         x, y, w, h = region
         cv2.rectangle(image, (x, y), (x+w, y+h), (0, 255, 0), 2)
         cv2.imwrite('./debug_number_screenshot.png', image)
@@ -579,38 +841,80 @@ class GameAutomation:
         self.screen.getch()
 
     def setup_logging(self):
-        logging.basicConfig(filename='debug.log', level=logging.DEBUG, 
-                            format='%(asctime)s - %(message)s', datefmt='%Y-%m-%d %H:%M:%S')
+        self.log_writer = setup_logging(self.log_file)
+        self.logger = logging.getLogger('bot')
+        self.logger.setLevel(logging.DEBUG if self.debug else logging.INFO)
+
+    def run_iteration(self):
+        if self.check_if_stuck():
+            self.stuck_recovery_action()
+            return None
+
+        # Without periodic captures every loop asks for its own frame
+        if self.capture_scheduler.demand_only:
+            frame = self.capture_scheduler.request_frame()
+        else:
+            frame = self.frame_store.consume()
+        state = self.state_machine.tick(frame)
+
+        self.debug_print("Loop %d: State: %s, Gold: %s", self.loop_count, state, self.gold_held)
+
+        self.state_handlers[state]()
+        return frame, state
 
     def run(self):
+        if self.metrics_exporter:
+            self.metrics_exporter.start()
+
         while self.running:
+            if self.replay_session and self.device.finished:
+                # Stopping here rather than from outside keeps where a replay ends repeatable too
+                break
             if not self.pause:
                 self.loop_count += 1
-                self.is_in_battle = self.check_if_is_in_battle()
 
-                self.debug_print(f"Loop {self.loop_count}: In battle: {self.is_in_battle}, Gold: {self.gold_held}")
-
-                if self.is_in_battle:
-                    self.handle_battle_state()
+                try:
+                    with self.metrics.span('run_iteration'):
+                        result = self.run_iteration()
+                except InvalidTransition as e:
+                    # An unexpected flow costs one iteration, not the whole bot
+                    self.logger.warning("%s, re-detecting the screen", e)
+                    self.state_machine.reset(f"recovered from: {e}")
+                    continue
+                if result is None:
                     continue
 
-                is_on_menu = self.check_if_is_on_menu()
-
-                if is_on_menu:
-                    self.handle_menu_state()
-                else:
-                    self.is_in_battle = True
-                    self.touch_screen(500, 1900)
-                    close_battle_button = self.analyze_image('close-battle-button.png')
-
-                    if close_battle_button:
-                        self.exit_battle()
+                frame, state = result
+                if self.capture_scheduler.demand_only:
+                    continue
+                if state == 'battle':
+                    # Battles react to the next frame rather than a fixed delay
+                    self.frame_store.wait_for_frame(frame.seq if frame else 0, 0.1)
+                    continue
 
             time.sleep(0.1)
 
-        curses.endwin()
+        self.shutdown()
+        if not self.headless:
+            curses.endwin()
         print("Bot instance stopped.")
 
+    def shutdown(self):
+        # Producers first, so nothing taps or captures on a device whose connections are closing
+        self.spawn_scheduler.close()
+        self.capture_scheduler.stop()
+        if self.pipeline:
+            self.pipeline.stop()
+        self.device_io.close()
+        self.input.close()
+        # The screenrecord stream's relay and decode threads would otherwise keep the device busy
+        self.capture.close()
+        if self.record_session:
+            self.device.close()
+        if self.metrics_exporter:
+            self.metrics_exporter.stop()
+        self.log_writer.stop()
+
 if __name__ == "__main__":
     try:
         game_automation = GameAutomation()
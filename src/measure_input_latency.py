@@ -0,0 +1,65 @@
+import argparse
+import glob
+import os
+import time
+
+from ppadb.client import Client as AdbClient
+from utils.fake_adb_server import FakeAdbServer
+from utils.fake_device import FakeDevice
+from utils.input_driver import ShellInputDriver, SendeventInputDriver
+
+
+def time_taps(label, tap, count):
+    start = time.perf_counter()
+    for i in range(count):
+        tap(500 + i, 1000)
+    elapsed = time.perf_counter() - start
+    print(f"{label}: {1000 * elapsed / count:.2f} ms per tap, until the device ran it")
+
+
+def main():
+    # Every driver call returns once the device has run the command, so these are round trips
+    parser = argparse.ArgumentParser(description="Measure per-tap latency of one-off shells against the persistent input drivers")
+    parser.add_argument('--real', action='store_true', help="Use the first device of the local adb server instead of a fake one")
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help="Simulated cost in seconds of a one-off shell command on the fake server")
+    parser.add_argument('--input-latency', type=float, default=0.03,
+                        help="Simulated run time in seconds of the input tool on the fake device")
+    args = parser.parse_args()
+
+    server = None
+    if args.real:
+        device = AdbClient(host="127.0.0.1", port=5037).devices()[0]
+    else:
+        repo_root = os.path.join(os.path.dirname(__file__), '..')
+        server = FakeAdbServer(FakeDevice.from_images(glob.glob(os.path.join(repo_root, '*screen*.png')),
+                                                      input_latency=args.input_latency),
+                               latency=args.latency).start()
+        device = AdbClient(host="127.0.0.1", port=server.port).devices()[0]
+
+    try:
+        time_taps("one-off shell", lambda x, y: device.shell(f"input tap {x} {y}"), args.count)
+
+        driver = ShellInputDriver(device)
+        time_taps("persistent shell", driver.tap, args.count)
+
+        start = time.perf_counter()
+        with driver.batch() as batch:
+            for i in range(args.count):
+                batch.tap(500 + i, 1000)
+        print(f"persistent shell, one batch: {1000 * (time.perf_counter() - start) / args.count:.2f} ms per tap")
+        driver.close()
+
+        driver = SendeventInputDriver(device)
+        time_taps("sendevent", driver.tap, args.count)
+        driver.close()
+    finally:
+        if server:
+            time.sleep(0.2)
+            print(f"fake server received {len(server.requests)} requests")
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+import argparse
+import os
+import sys
+import threading
+import time
+
+import cv2 as cv
+
+from main import GameAutomation
+from utils.session import session_from_images
+
+REPO_ROOT = os.path.join(os.path.dirname(__file__), '..')
+SESSIONS_DIR = os.path.join(os.path.dirname(__file__), 'sessions')
+FIXTURE_PATH = os.path.join(SESSIONS_DIR, 'screenshots.session')
+
+# The full screenshots saved in the repo, each held for a few captures
+FIXTURE_SCREENSHOTS = ['debug_number_screenshot.png', 'number_screencap.png']
+FIXTURE_REPEAT = 10
+
+
+def build_fixture(path=FIXTURE_PATH):
+    paths = [os.path.join(REPO_ROOT, name) for name in FIXTURE_SCREENSHOTS]
+    height, width = cv.imread(paths[0]).shape[:2]
+    frames = session_from_images(paths, path, repeat=FIXTURE_REPEAT,
+                                 shell_outputs={'wm size': f"Physical size: {width}x{height}\n"})
+    print(f"Wrote {frames} frames to {path} ({os.path.getsize(path) / 1024:.0f} KiB)")
+
+
+def replay(path, timeout, **options):
+    bot = GameAutomation(headless=True, replay_session=path, log_file=os.devnull, **options)
+    if not bot.initialize():
+        raise RuntimeError(f"Could not replay {path}")
+    device = bot.device
+
+    start = time.perf_counter()
+    thread = threading.Thread(target=bot.run, daemon=True)
+    thread.start()
+    # The bot stops by itself once the recording runs out; only a stuck replay is stopped from here
+    thread.join(timeout)
+    if thread.is_alive():
+        bot.running = False
+        thread.join()
+        print(f"Replay did not finish within {timeout:.0f} s")
+    elapsed = time.perf_counter() - start
+
+    session = device.session
+    recorded = session.frame_times[-1] - session.frame_times[0] if len(session.frame_times) > 1 else 0.0
+    print(f"Replayed {min(device.frame_index, len(device.frames))}/{len(device.frames)} frames in {elapsed:.2f} s "
+          f"(recorded over {recorded:.2f} s, {device.clock() - session.frame_times[0]:.2f} s of bot time "
+          f"over {device.frame_index} captures)")
+    print(f"Input commands: {len(device.input_commands())} replayed, {len(session.inputs)} recorded")
+    for timestamp, previous, state, reason in bot.state_machine.transitions:
+        print(f"  {previous} -> {state} ({reason})")
+    return device.input_commands(), [transition[1:] for transition in bot.state_machine.transitions]
+
+
+def check_deterministic(path, timeout, runs=2, **options):
+    # The same recording has to produce the same input log and the same state transitions on every run
+    results = [replay(path, timeout, **options) for _ in range(runs)]
+    for index, (inputs, transitions) in enumerate(results[1:], start=2):
+        if inputs != results[0][0]:
+            print(f"Run {index} sent different input commands than run 1:")
+            for first, other in zip(results[0][0] + [None] * len(inputs), inputs + [None] * len(results[0][0])):
+                if first != other:
+                    print(f"  {first!r} != {other!r}")
+                    break
+            return False
+        if transitions != results[0][1]:
+            print(f"Run {index} went through different states than run 1")
+            return False
+    print(f"{runs} runs sent the same {len(results[0][0])} input commands")
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the bot against a recorded session instead of a device")
+    parser.add_argument('session', nargs='?', default=FIXTURE_PATH)
+    parser.add_argument('--build-fixture', action='store_true', help="Rebuild the fixture from the repo screenshots")
+    parser.add_argument('--timeout', type=float, default=30.0)
+    # Raw by default: PNG decoding a full screen costs about as long as the recording spends on a frame
+    parser.add_argument('--capture', default='raw', help="Capture backend the bot uses during replay")
+    parser.add_argument('--check', action='store_true', help="Replay twice and fail unless both runs send the same input")
+    args = parser.parse_args()
+
+    if args.build_fixture:
+        build_fixture()
+        return
+    if args.check:
+        if not check_deterministic(args.session, args.timeout, capture_backend=args.capture):
+            sys.exit(1)
+        return
+    replay(args.session, args.timeout, capture_backend=args.capture)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.capture import create_capture_backend
+from utils.input_driver import ShellInputDriver
+
+
+class AsyncDevice:
+    def __init__(self, device, capture=None, input_driver=None, cpu_workers=4):
+        self.device = device
+        self.capture_backend = capture or create_capture_backend('png', device)
+        self.input_driver = input_driver or ShellInputDriver(device)
+        # ADB calls block on sockets and OpenCV/Tesseract release the GIL, so plain
+        # thread pools are enough to keep the event loop free
+        self.io_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='adb-io')
+        self.cpu_executor = ThreadPoolExecutor(max_workers=cpu_workers, thread_name_prefix='analysis')
+
+    async def _io(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.io_executor, function, *args)
+
+    async def capture(self):
+        return await self._io(self.capture_backend.capture)
+
+    async def tap(self, x, y):
+        await self._io(self.input_driver.tap, x, y)
+
+    async def swipe(self, x1, y1, x2, y2, duration):
+        await self._io(self.input_driver.swipe, x1, y1, x2, y2, duration)
+
+    async def shell(self, cmd):
+        return await self._io(self.device.shell, cmd)
+
+    async def analyze(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.cpu_executor, function, *args)
+
+    async def analyze_many(self, calls):
+        # (function, *args) tuples run side by side; a failed call returns its exception in its place
+        return await asyncio.gather(*(self.analyze(function, *args) for function, *args in calls),
+                                    return_exceptions=True)
+
+    async def tap_and_capture(self, x, y):
+        # The capture is already on its way while the tap goes out, instead of after it
+        _, captured = await asyncio.gather(self.tap(x, y), self.capture())
+        return captured
+
+    def close(self):
+        self.io_executor.shutdown(wait=False)
+        self.cpu_executor.shutdown(wait=False)
+
+
+class BlockingDevice:
+    # Runs an AsyncDevice on a private event loop thread for synchronous callers
+    def __init__(self, async_device):
+        self.async_device = async_device
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def run(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def capture(self):
+        return self.run(self.async_device.capture())
+
+    def tap(self, x, y):
+        self.run(self.async_device.tap(x, y))
+
+    def swipe(self, x1, y1, x2, y2, duration):
+        self.run(self.async_device.swipe(x1, y1, x2, y2, duration))
+
+    def shell(self, cmd):
+        return self.run(self.async_device.shell(cmd))
+
+    def analyze(self, function, *args):
+        return self.run(self.async_device.analyze(function, *args))
+
+    def analyze_many(self, calls):
+        return self.run(self.async_device.analyze_many(calls))
+
+    def tap_and_capture(self, x, y):
+        return self.run(self.async_device.tap_and_capture(x, y))
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout=1)
+        self.async_device.close()
@@ -0,0 +1,297 @@
+import logging
+import socket
+import struct
+import threading
+import time
+
+import cv2 as cv
+import numpy as np
+
+from utils.device_info import read_screen_size
+from utils.frame_store import decode_png
+from utils.metrics import REGISTRY
+
+logger = logging.getLogger('bot.capture')
+
+# android.graphics.PixelFormat values written by screencap
+RAW_PIXEL_FORMATS = {
+    1: ('RGBA', 4),  # RGBA_8888
+    2: ('RGBA', 4),  # RGBX_8888, alpha byte is ignored
+    3: ('RGB', 3),   # RGB_888
+    4: ('BGR565', 2),  # RGB_565, little endian so OpenCV sees it as BGR565
+    5: ('BGRA', 4),  # BGRA_8888
+}
+
+
+def parse_raw_framebuffer(data):
+    if len(data) < 12:
+        raise ValueError(f"Raw screencap too short ({len(data)} bytes)")
+
+    width, height, pixel_format = struct.unpack_from('<3I', data, 0)
+    if pixel_format not in RAW_PIXEL_FORMATS:
+        raise ValueError(f"Unsupported raw screencap pixel format {pixel_format}")
+
+    name, bytes_per_pixel = RAW_PIXEL_FORMATS[pixel_format]
+    pixel_bytes = width * height * bytes_per_pixel
+
+    # Android 9+ appends a dataspace field to the 12 byte header
+    header_size = len(data) - pixel_bytes
+    if header_size not in (12, 16):
+        raise ValueError(f"Raw screencap size mismatch: {len(data)} bytes for {width}x{height} format {pixel_format}")
+
+    pixels = np.frombuffer(data, dtype=np.uint8, count=pixel_bytes, offset=header_size)
+    if bytes_per_pixel == 2:
+        return pixels.reshape(height, width, 2), name
+    return pixels.reshape(height, width, bytes_per_pixel), name
+
+
+def encode_raw_framebuffer(image, pixel_format=1, dataspace=None):
+    height, width = image.shape[:2]
+    header = struct.pack('<3I', width, height, pixel_format)
+    if dataspace is not None:
+        header += struct.pack('<I', dataspace)
+    return header + np.ascontiguousarray(image).tobytes()
+
+
+def read_raw_screencap(device):
+    conn = device.create_connection()
+    with conn:
+        # exec: skips the pty so the binary output is not mangled by \r\n translation
+        conn.send("exec:/system/bin/screencap")
+        return conn.read_all()
+
+
+class PngCapture:
+    name = 'png'
+
+    def __init__(self, device):
+        self.device = device
+
+    def grab(self):
+        return self.device.screencap()
+
+    @staticmethod
+    def decode(data):
+        return decode_png(data), 'BGR'
+
+    def capture(self):
+        with REGISTRY.span('screencap', self.name):
+            data = self.grab()
+        with REGISTRY.span('decode', self.name):
+            return self.decode(data)
+
+    def close(self):
+        pass
+
+
+class RawCapture:
+    name = 'raw'
+
+    def __init__(self, device):
+        self.device = device
+
+    def grab(self):
+        return read_raw_screencap(self.device)
+
+    @staticmethod
+    def decode(data):
+        return parse_raw_framebuffer(data)
+
+    def capture(self):
+        with REGISTRY.span('screencap', self.name):
+            data = self.grab()
+        with REGISTRY.span('decode', self.name):
+            return self.decode(data)
+
+    def close(self):
+        pass
+
+
+class ScreenrecordCapture:
+    # Keeps one screenrecord H.264 stream running and hands out its latest decoded frame.
+    # The stream is relayed from the adb socket to a local TCP port that OpenCV's FFmpeg
+    # backend reads from, since VideoCapture cannot take a Python byte stream directly.
+    name = 'screenrecord'
+
+    def __init__(self, device, scale=1.0, bit_rate=None, frame_timeout=2.0, max_backoff=5.0):
+        self.device = device
+        # Below 1.0 the device encodes a smaller video, frames are scaled back up to screen coordinates
+        self.scale = scale
+        self.bit_rate = bit_rate
+        self.frame_timeout = frame_timeout
+        self.max_backoff = max_backoff
+        self.screen_size = None
+        self.condition = threading.Condition()
+        self.image = None
+        self.image_seq = 0
+        self.returned_seq = 0
+        self.last_frame_time = None
+        self.streaming = False
+        self.connection = None
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.restarts = 0
+        self.frames_decoded = 0
+
+    def command(self):
+        parts = ['screenrecord', '--output-format=h264']
+        if self.scale != 1.0:
+            width, height = self.screen_size
+            # Encoders want even dimensions
+            parts.append(f"--size {int(width * self.scale) // 2 * 2}x{int(height * self.scale) // 2 * 2}")
+        if self.bit_rate:
+            parts.append(f"--bit-rate {self.bit_rate}")
+        parts.append('-')
+        return ' '.join(parts)
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.screen_size = read_screen_size(self.device)
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        backoff = 0.1
+        while not self.stop_event.is_set():
+            try:
+                frames = self._stream()
+            except (OSError, RuntimeError, cv.error) as e:
+                logger.warning("screenrecord stream failed: %s", e)
+                frames = 0
+            if self.stop_event.is_set():
+                return
+
+            # screenrecord exits on its own after its time limit, a stream that produced frames restarts at once
+            backoff = 0.1 if frames else min(backoff * 2, self.max_backoff)
+            self.restarts += 1
+            logger.info("Restarting screenrecord stream (restart %d) after %d frames", self.restarts, frames)
+            self.stop_event.wait(0 if frames else backoff)
+
+    def _relay(self, listener, connection):
+        try:
+            client, _ = listener.accept()
+        except OSError:
+            connection.close()
+            return
+        with client:
+            try:
+                while True:
+                    data = connection.read(65536)
+                    if not data:
+                        return
+                    client.sendall(data)
+            except OSError:
+                pass
+            finally:
+                connection.close()
+
+    def _stream(self):
+        connection = self.device.create_connection()
+        connection.send(f"exec:{self.command()}")
+        self.connection = connection
+
+        listener = socket.create_server(('127.0.0.1', 0))
+        listener.settimeout(self.frame_timeout * 5)
+        port = listener.getsockname()[1]
+        relay = threading.Thread(target=self._relay, args=(listener, connection), daemon=True)
+        relay.start()
+
+        video = cv.VideoCapture(f"tcp://127.0.0.1:{port}", cv.CAP_FFMPEG)
+        frames = 0
+        try:
+            if not video.isOpened():
+                raise RuntimeError("Could not open the screenrecord stream")
+            self.streaming = True
+            while not self.stop_event.is_set():
+                ok, image = video.read()
+                if not ok:
+                    break
+                if image.shape[1::-1] != self.screen_size:
+                    image = cv.resize(image, self.screen_size, interpolation=cv.INTER_LINEAR)
+                with self.condition:
+                    self.image = image
+                    self.image_seq += 1
+                    self.last_frame_time = time.monotonic()
+                    self.condition.notify_all()
+                frames += 1
+                self.frames_decoded += 1
+        finally:
+            self.streaming = False
+            video.release()
+            connection.close()
+            listener.close()
+            relay.join(timeout=1)
+        return frames
+
+    def grab(self):
+        # Packs the decoded frame like a raw screencap, so the analysis pipeline can hand it to workers
+        image, _ = self.capture()
+        return encode_raw_framebuffer(cv.cvtColor(image, cv.COLOR_BGR2RGBA), pixel_format=1)
+
+    @staticmethod
+    def decode(data):
+        return parse_raw_framebuffer(data)
+
+    def capture(self):
+        self.start()
+        with REGISTRY.span('screencap', self.name):
+            with self.condition:
+                # screenrecord only emits frames when the screen changes, so after a short wait
+                # for a newer one the latest frame is still the current screen
+                self.condition.wait_for(lambda: self.image_seq > self.returned_seq, 1 / 30)
+                if self.image is None:
+                    self.condition.wait_for(lambda: self.image is not None, self.frame_timeout)
+                stale = (self.last_frame_time is None
+                         or not self.streaming and time.monotonic() - self.last_frame_time > self.frame_timeout)
+                if self.image is None or stale:
+                    raise RuntimeError("No frames from the screenrecord stream")
+                self.returned_seq = self.image_seq
+                return self.image, 'BGR'
+
+    def close(self):
+        self.stop_event.set()
+        if self.connection is not None:
+            self.connection.close()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+            self.thread = None
+
+
+CAPTURE_BACKENDS = {
+    PngCapture.name: PngCapture,
+    RawCapture.name: RawCapture,
+    ScreenrecordCapture.name: ScreenrecordCapture,
+}
+
+
+def create_capture_backend(name, device, **options):
+    if name not in CAPTURE_BACKENDS:
+        raise ValueError(f"Unknown capture backend '{name}', expected one of {sorted(CAPTURE_BACKENDS)}")
+    return CAPTURE_BACKENDS[name](device, **options)
+
+
+def compare_capture_backends(device, iterations=20):
+    results = {}
+    for name, backend_class in CAPTURE_BACKENDS.items():
+        backend = backend_class(device)
+        timings = []
+        try:
+            for _ in range(iterations):
+                start = time.perf_counter()
+                image, pixel_format = backend.capture()
+                timings.append(time.perf_counter() - start)
+        except RuntimeError as e:
+            # e.g. a fake device without a video has no screenrecord stream
+            results[name] = {'error': str(e)}
+            continue
+        finally:
+            backend.close()
+        results[name] = {
+            'mean_ms': 1000 * sum(timings) / len(timings),
+            'min_ms': 1000 * min(timings),
+            'shape': image.shape,
+            'pixel_format': pixel_format,
+        }
+    return results
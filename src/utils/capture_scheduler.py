@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from collections import deque
+
+# Seconds between periodic captures per mode; None means only capture on demand
+MODE_INTERVALS = {
+    'battle_end': 0.02,
+    'battle': 0.05,
+    'menu': 0.25,
+    'paused': None,
+}
+
+# Pause after a failed capture, so a disconnected device is not hammered in a tight loop
+ERROR_BACKOFF = 0.5
+
+logger = logging.getLogger('bot.capture')
+
+
+class CaptureScheduler:
+    def __init__(self, capture, frame_store, intervals=None, mode='menu'):
+        self.capture = capture
+        self.frame_store = frame_store
+        self.intervals = dict(MODE_INTERVALS, **(intervals or {}))
+        self.mode = mode
+        self.demand = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.capture_times = deque(maxlen=50)
+        self.captures = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def set_mode(self, mode):
+        if mode not in self.intervals:
+            raise ValueError(f"Unknown capture mode '{mode}'")
+        if mode != self.mode:
+            self.mode = mode
+            # Wake the loop so a faster rate applies now rather than after the old interval; a mode
+            # without periodic captures has nothing to apply, and a capture here would be unasked for
+            if self.intervals[mode] is not None:
+                self.demand.set()
+
+    @property
+    def demand_only(self):
+        return all(interval is None for interval in self.intervals.values())
+
+    def capture_on_demand_only(self):
+        # Every frame is one somebody asked for, e.g. so a replay consumes the same frames each run
+        self.intervals = dict.fromkeys(self.intervals)
+
+    def request_frame(self, after_seq=None, timeout=1.0):
+        after_seq = self.frame_store.seq if after_seq is None else after_seq
+        self.demand.set()
+        frame = self.frame_store.wait_for_frame(after_seq, timeout)
+        if frame is None or frame.seq <= after_seq:
+            return None
+        self.frame_store.mark_consumed(frame)
+        return frame
+
+    def start(self):
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stop_event.set()
+        self.demand.set()
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+
+    def _run(self):
+        while not self.stop_event.is_set():
+            demanded = self.demand.wait(self.intervals[self.mode])
+            if self.stop_event.is_set():
+                return
+            self.demand.clear()
+
+            # Backpressure: a periodic capture waits until the previous frame was analysed
+            if not demanded and self.frame_store.seq > self.frame_store.consumed_seq:
+                self.skipped += 1
+                continue
+
+            try:
+                frame = self.capture()
+            except Exception as e:
+                # One failed screencap must not end the thread every wait_until depends on
+                self.errors += 1
+                logger.warning("Capture failed: %r", e)
+                self.stop_event.wait(ERROR_BACKOFF)
+                continue
+
+            if frame is not None:
+                self.captures += 1
+                self.capture_times.append(time.monotonic())
+
+    def fps(self):
+        if len(self.capture_times) < 2:
+            return 0.0
+        elapsed = time.monotonic() - self.capture_times[0]
+        return (len(self.capture_times) - 1) / elapsed if elapsed else 0.0
+
+    def stats(self):
+        return {
+            'mode': self.mode,
+            'fps': self.fps(),
+            'captures': self.captures,
+            'skipped': self.skipped,
+            'dropped': self.frame_store.dropped,
+            'errors': self.errors,
+        }
@@ -0,0 +1,67 @@
+import cv2 as cv
+import numpy as np
+
+THUMBNAIL_SCALE = 8
+# Tiles are in thumbnail pixels, so each covers 128x128 screen pixels
+TILE_SIZE = 16
+# Mean absolute difference, in gray levels, above which a tile counts as changed
+DIRTY_THRESHOLD = 3.0
+
+
+class ChangeTracker:
+    def __init__(self, scale=THUMBNAIL_SCALE, tile_size=TILE_SIZE, threshold=DIRTY_THRESHOLD):
+        self.scale = scale
+        self.tile_size = tile_size
+        self.threshold = threshold
+        self.baseline = None
+        # Sequence number of the last frame in which each tile changed
+        self.tile_changed_seq = None
+        self.last_seq = 0
+        self.last_dirty_tiles = 0
+
+    def _thumbnail(self, gray):
+        height, width = gray.shape[:2]
+        return cv.resize(gray, (width // self.scale, height // self.scale), interpolation=cv.INTER_AREA)
+
+    def update(self, frame):
+        if frame.seq <= self.last_seq:
+            return self.last_dirty_tiles
+
+        thumbnail = self._thumbnail(frame.gray)
+        rows = -(-thumbnail.shape[0] // self.tile_size)
+        cols = -(-thumbnail.shape[1] // self.tile_size)
+        self.last_seq = frame.seq
+
+        if self.baseline is None or self.baseline.shape != thumbnail.shape:
+            self.baseline = thumbnail
+            self.tile_changed_seq = np.full((rows, cols), frame.seq, dtype=np.int64)
+            self.last_dirty_tiles = rows * cols
+            return self.last_dirty_tiles
+
+        difference = cv.absdiff(thumbnail, self.baseline)
+        # Pad to whole tiles and average each tile with a reshape instead of a loop
+        padded = np.zeros((rows * self.tile_size, cols * self.tile_size), dtype=np.float32)
+        padded[:difference.shape[0], :difference.shape[1]] = difference
+        tile_means = padded.reshape(rows, self.tile_size, cols, self.tile_size).mean(axis=(1, 3))
+        dirty = tile_means > self.threshold
+
+        # Only dirty tiles move the baseline, so slow drift accumulates until it is noticed
+        for row, col in zip(*np.nonzero(dirty)):
+            y, x = row * self.tile_size, col * self.tile_size
+            self.baseline[y:y + self.tile_size, x:x + self.tile_size] = thumbnail[y:y + self.tile_size, x:x + self.tile_size]
+        self.tile_changed_seq[dirty] = frame.seq
+        self.last_dirty_tiles = int(np.count_nonzero(dirty))
+        return self.last_dirty_tiles
+
+    def changed_since(self, seq, region=None):
+        if self.tile_changed_seq is None:
+            return True
+        if region is None:
+            return bool(self.tile_changed_seq.max() > seq)
+
+        cell = self.scale * self.tile_size
+        x1, y1, x2, y2 = region
+        rows, cols = self.tile_changed_seq.shape
+        tiles = self.tile_changed_seq[max(0, y1 // cell):min(rows, -(-y2 // cell)),
+                                      max(0, x1 // cell):min(cols, -(-x2 // cell))]
+        return tiles.size == 0 or bool(tiles.max() > seq)
@@ -0,0 +1,80 @@
+import time
+
+import cv2 as cv
+
+# Mean absolute difference, in gray levels, of a 1/8 thumbnail that counts as a change
+CHANGE_THRESHOLD = 4.0
+
+
+def _thumbnail(frame, region):
+    gray = frame.gray
+    if region:
+        x1, y1, x2, y2 = region
+        gray = gray[y1:y2, x1:x2]
+    height, width = gray.shape[:2]
+    return cv.resize(gray, (max(1, width // 8), max(1, height // 8)), interpolation=cv.INTER_AREA)
+
+
+def _difference(a, b):
+    return cv.norm(a, b, cv.NORM_L1) / a.size
+
+
+class ScreenChanged:
+    # True once the region differs from how it looked when the condition was created
+    def __init__(self, reference_frame, region=None, threshold=CHANGE_THRESHOLD):
+        self.region = region
+        self.threshold = threshold
+        self.reference = _thumbnail(reference_frame, region) if reference_frame is not None else None
+
+    def __call__(self, frame):
+        if self.reference is None:
+            return True
+        return _difference(_thumbnail(frame, self.region), self.reference) > self.threshold
+
+
+class ScreenSettled:
+    # True once two consecutive frames look the same, i.e. animations have finished
+    def __init__(self, region=None, threshold=CHANGE_THRESHOLD):
+        self.region = region
+        self.threshold = threshold
+        self.previous = None
+
+    def __call__(self, frame):
+        thumbnail = _thumbnail(frame, self.region)
+        settled = self.previous is not None and _difference(thumbnail, self.previous) <= self.threshold
+        self.previous = thumbnail
+        return settled
+
+
+class ScreenChangedAndSettled:
+    # True once the region has changed from the reference and then held still for a frame, so the
+    # frame returned shows where a tap's animation ended rather than a step along the way
+    def __init__(self, reference_frame, region=None, threshold=CHANGE_THRESHOLD):
+        self.changed = ScreenChanged(reference_frame, region, threshold)
+        self.settled = ScreenSettled(region, threshold)
+        self.has_changed = False
+
+    def __call__(self, frame):
+        if not self.has_changed:
+            self.has_changed = self.changed(frame)
+            if self.has_changed:
+                # The first changed frame is what the next one has to match
+                self.settled(frame)
+            return False
+        return self.settled(frame)
+
+
+def wait_until(request_frame, predicate, timeout, after_seq=0, clock=time.monotonic, request_timeout=None):
+    # With a clock other than the wall clock, e.g. a replay's recorded time, the timeout is measured
+    # on that clock and each frame request gets request_timeout of real time instead
+    deadline = clock() + timeout
+    while True:
+        remaining = deadline - clock()
+        if remaining <= 0:
+            return None
+        frame = request_frame(after_seq, request_timeout or remaining)
+        if frame is None:
+            return None
+        if predicate(frame):
+            return frame
+        after_seq = frame.seq
@@ -0,0 +1,10 @@
+import re
+
+
+def read_screen_size(device):
+    sizes = re.findall(r'(\d+)x(\d+)', device.shell("wm size"))
+    if not sizes:
+        raise RuntimeError("Could not read screen size from wm size")
+    # An override size, when present, is listed last and is what the app sees
+    width, height = sizes[-1]
+    return int(width), int(height)
@@ -0,0 +1,181 @@
+import os
+import re
+import threading
+
+import cv2 as cv
+import numpy as np
+
+from utils.number_parsing import parse_number_text
+
+GLYPH_WIDTH = 16
+GLYPH_HEIGHT = 24
+GLYPH_LABELS = '0123456789kmb'
+DEFAULT_ATLAS_PATH = os.path.join(os.path.dirname(__file__), '..', 'digit_atlas.npz')
+DEFAULT_CONFIDENCE_THRESHOLD = 0.85
+MAX_SAMPLES_PER_LABEL = 8
+
+# Connected components smaller than this fraction of the tallest one are noise,
+# unless they sit on the baseline where they are read as a decimal point
+MIN_GLYPH_HEIGHT_RATIO = 0.5
+MIN_DOT_HEIGHT_RATIO = 0.1
+MAX_DOT_HEIGHT_RATIO = 0.4
+MIN_GLYPH_AREA = 6
+# Anything wider than this relative to its height is a merged blob, not one glyph
+MAX_GLYPH_ASPECT = 1.2
+
+NUMBER_LABEL_PATTERN = re.compile(r'^\d+(\.\d+)?[kmb]?$')
+
+
+def binarize(crop):
+    # The HUD font is white with a dark outline, so Otsu cleanly separates it
+    _, binary = cv.threshold(crop, 0, 255, cv.THRESH_BINARY + cv.THRESH_OTSU)
+    if np.count_nonzero(binary) > binary.size // 2:
+        binary = cv.bitwise_not(binary)
+    return binary
+
+
+def segment_glyphs(crop):
+    binary = binarize(crop)
+    count, _, stats, _ = cv.connectedComponentsWithStats(binary, connectivity=8)
+    crop_height, crop_width = binary.shape[:2]
+    # Drop specks and the button/background outline spanning the whole region
+    boxes = [tuple(stats[i][:4]) for i in range(1, count)
+             if stats[i][cv.CC_STAT_AREA] >= MIN_GLYPH_AREA
+             and stats[i][cv.CC_STAT_HEIGHT] < crop_height and stats[i][cv.CC_STAT_WIDTH] < crop_width * 0.8]
+    if not boxes:
+        return binary, []
+
+    tallest = max(h for _, _, _, h in boxes)
+    baseline = max(y + h for _, y, _, h in boxes if h >= tallest * MIN_GLYPH_HEIGHT_RATIO)
+
+    glyphs = []
+    for x, y, w, h in sorted(boxes):
+        if h >= tallest * MIN_GLYPH_HEIGHT_RATIO:
+            # Glyphs cut off by the left edge of the region belong to the icon next to the number
+            if x == 0 and w < h // 3:
+                continue
+            glyphs.append(('glyph', (x, y, w, h)))
+        elif tallest * MIN_DOT_HEIGHT_RATIO <= h <= tallest * MAX_DOT_HEIGHT_RATIO and abs(y + h - baseline) <= tallest * 0.15 and w <= h * 2:
+            glyphs.append(('.', (x, y, w, h)))
+    return binary, glyphs
+
+
+def normalize_glyph(binary, box):
+    x, y, w, h = box
+    glyph = binary[y:y + h, x:x + w]
+    # Scale to the atlas height and pad to the atlas width so the aspect ratio survives
+    scale = GLYPH_HEIGHT / h
+    width = max(1, min(GLYPH_WIDTH, int(round(w * scale))))
+    resized = cv.resize(glyph, (width, GLYPH_HEIGHT), interpolation=cv.INTER_AREA)
+    padded = np.zeros((GLYPH_HEIGHT, GLYPH_WIDTH), dtype=np.float32)
+    offset = (GLYPH_WIDTH - width) // 2
+    padded[:, offset:offset + width] = resized
+    return padded
+
+
+def _unit_vector(glyph):
+    vector = glyph.reshape(-1).astype(np.float32)
+    vector -= vector.mean()
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+class DigitOCR:
+    def __init__(self, atlas_path=DEFAULT_ATLAS_PATH, confidence_threshold=DEFAULT_CONFIDENCE_THRESHOLD,
+                 learned_path=None):
+        # The bundled atlas is never written at runtime; learned glyphs go to learned_path, which
+        # holds the bundled glyphs plus the learned ones and is loaded instead once it exists
+        self.atlas_path = atlas_path
+        self.learned_path = learned_path
+        self.confidence_threshold = confidence_threshold
+        # Regions are read on several threads; learn() replaces labels and vectors together under
+        # the lock so readers always see a matching pair, and save() never runs twice at once
+        self.lock = threading.Lock()
+        self.labels = []
+        self.vectors = np.zeros((0, GLYPH_WIDTH * GLYPH_HEIGHT), dtype=np.float32)
+        if learned_path and os.path.exists(learned_path):
+            self.load(learned_path)
+        elif atlas_path and os.path.exists(atlas_path):
+            self.load(atlas_path)
+
+    def load(self, path):
+        with np.load(path) as atlas:
+            glyphs = atlas['glyphs']
+            self.labels = [str(label) for label in atlas['labels']]
+        self.vectors = np.stack([_unit_vector(glyph) for glyph in glyphs]) if len(glyphs) else self.vectors
+
+    def save(self, path=None):
+        path = path or self.learned_path
+        if not path:
+            raise ValueError("No path to save the atlas to, learning is off without a learned_path")
+        with self.lock:
+            glyphs = self.vectors.reshape(-1, GLYPH_HEIGHT, GLYPH_WIDTH)
+            np.savez_compressed(path, glyphs=glyphs, labels=np.array(self.labels))
+
+    def read_text(self, crop):
+        with self.lock:
+            labels, vectors = self.labels, self.vectors
+        binary, glyphs = segment_glyphs(crop)
+        if not glyphs or not labels:
+            return '', 0.0
+
+        text = []
+        confidence = 1.0
+        for kind, box in glyphs:
+            if kind == '.':
+                text.append('.')
+                continue
+            _, _, w, h = box
+            if w > h * MAX_GLYPH_ASPECT:
+                return '', 0.0
+            scores = vectors @ _unit_vector(normalize_glyph(binary, box))
+            best = int(np.argmax(scores))
+            text.append(labels[best])
+            confidence = min(confidence, float(scores[best]))
+
+        text = ''.join(text)
+        if not NUMBER_LABEL_PATTERN.match(text):
+            return text, 0.0
+        return text, confidence
+
+    def read(self, crop):
+        text, confidence = self.read_text(crop)
+        if confidence < self.confidence_threshold:
+            return None, confidence
+        return parse_number_text(text), confidence
+
+    def learn(self, crop, text):
+        # Adds the glyphs of a crop whose reading is known, e.g. from a Tesseract
+        # fallback, so the atlas grows to cover the digits actually seen in game.
+        # Nothing is added when any glyph contradicts the atlas.
+        label = re.sub(r'[^0-9.kmb]', '', text.lower())
+        if not NUMBER_LABEL_PATTERN.match(label):
+            return False
+
+        binary, glyphs = segment_glyphs(crop)
+        if len(glyphs) != len(label) or any((kind == '.') != (char == '.') for (kind, _), char in zip(glyphs, label)):
+            return False
+
+        with self.lock:
+            labels, rows = list(self.labels), []
+            for (kind, box), char in zip(glyphs, label):
+                if kind == '.':
+                    continue
+                vector = _unit_vector(normalize_glyph(binary, box))
+                # A glyph the atlas already knows confidently as another character means the
+                # reading is wrong, e.g. Tesseract taking a 9 for an 8; learning it would make
+                # that misread permanent
+                if labels:
+                    scores = self.vectors @ vector
+                    best = int(np.argmax(scores))
+                    if labels[best] != char and scores[best] >= self.confidence_threshold:
+                        return False
+                if labels.count(char) >= MAX_SAMPLES_PER_LABEL:
+                    continue
+                labels.append(char)
+                rows.append(vector)
+            if not rows:
+                return False
+            self.vectors = np.vstack([self.vectors, *rows])
+            self.labels = labels
+        return True
@@ -0,0 +1,103 @@
+import socketserver
+import threading
+import time
+
+
+class FakeAdbHandler(socketserver.BaseRequestHandler):
+    def _read_request(self):
+        length = self._recv_exact(4)
+        if not length:
+            return None
+        return self._recv_exact(int(length.decode('utf-8'), 16)).decode('utf-8')
+
+    def _recv_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.request.recv(size - len(data))
+            if not chunk:
+                return data
+            data += chunk
+        return data
+
+    def _okay(self, payload=None):
+        self.request.sendall(b'OKAY')
+        if payload is not None:
+            encoded = payload.encode('utf-8')
+            self.request.sendall(f"{len(encoded):04X}".encode('utf-8') + encoded)
+
+    def handle(self):
+        server = self.server
+        # A connection stays open across host:transport and is handed to the device service after it
+        while True:
+            request = self._read_request()
+            if request is None:
+                return
+
+            if request == 'host:version':
+                self._okay('0029')
+                return
+            if request == 'host:devices':
+                self._okay(f"{server.device.serial}\tdevice\n")
+                return
+            if request.startswith('host:transport:'):
+                self._okay()
+                continue
+            if request == 'shell:':
+                self._okay()
+                self._interactive_shell()
+                return
+
+            self._okay()
+            server.record(request)
+            if server.latency:
+                time.sleep(server.latency)
+            self.request.sendall(bytes(server.device.handle_connection_command(request)))
+            return
+
+    def _interactive_shell(self):
+        buffer = b''
+        while True:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                return
+            buffer += chunk
+            *lines, buffer = buffer.split(b'\n')
+            for line in lines:
+                command = line.decode('utf-8').strip()
+                if command:
+                    self.server.record(f"shell:{command}")
+                    output = self.server.device.shell(command)
+                    if output:
+                        self.request.sendall(output.encode('utf-8'))
+
+
+# Speaks enough of the adb host protocol for ppadb's AdbClient to drive a FakeDevice
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, device, host='127.0.0.1', port=0, latency=0.0):
+        super().__init__((host, port), FakeAdbHandler)
+        self.device = device
+        # Simulated per-command cost of a one-off shell on a real device
+        self.latency = latency
+        self.requests = []
+        self.requests_lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def record(self, request):
+        with self.requests_lock:
+            self.requests.append((time.time(), request))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,166 @@
+import re
+import threading
+import time
+
+import cv2 as cv
+
+from utils.capture import encode_raw_framebuffer, parse_raw_framebuffer
+from utils.frame_store import BGR_CONVERSIONS
+
+
+def write_test_video(frames, path, fps=30, repeat=15):
+    # H.264 where the OpenCV build can encode it; MPEG-4 in Matroska otherwise. The capture
+    # side only relies on FFmpeg probing the stream, so either exercises the same path.
+    height, width = frames[0].shape[:2]
+    for fourcc, extension in (('avc1', '.h264'), ('mp4v', '.mkv')):
+        output = path + extension
+        writer = cv.VideoWriter(output, cv.VideoWriter_fourcc(*fourcc), fps, (width, height))
+        if writer.isOpened():
+            for frame in frames:
+                for _ in range(repeat):
+                    writer.write(frame)
+            writer.release()
+            return output
+    raise RuntimeError("This OpenCV build cannot encode a test video")
+
+
+class FakeConnection:
+    def __init__(self, device):
+        self.device = device
+        self.command = None
+        self.stream_offset = 0
+        # Output of commands written to an interactive shell, handed out by read()
+        self.output = b''
+        self.closed = False
+        self.condition = threading.Condition()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def send(self, msg):
+        self.command = msg
+        return True
+
+    def read_all(self):
+        return bytearray(self.device.handle_connection_command(self.command))
+
+    def read(self, length=0):
+        if self.command == 'shell:':
+            with self.condition:
+                self.condition.wait_for(lambda: self.output or self.closed)
+                chunk, self.output = self.output[:length or 4096], self.output[length or 4096:]
+                return chunk
+        # screenrecord streams the video once and then the stream ends, like screenrecord
+        # reaching its time limit
+        if self.command is None or 'screenrecord' not in self.command or self.device.video is None:
+            return b''
+        chunk = self.device.video[self.stream_offset:self.stream_offset + (length or 65536)]
+        self.stream_offset += len(chunk)
+        return chunk
+
+    def write(self, data):
+        for line in data.decode('utf-8').splitlines():
+            if line.strip():
+                output = self.device.shell(line.strip())
+                with self.condition:
+                    self.output += output.encode('utf-8')
+                    self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+# Stands in for a ppadb device, serving a fixed list of BGR frames in a loop
+class FakeDevice:
+    def __init__(self, frames, serial='fake-device', video=None, input_latency=0.0):
+        self.serial = serial
+        # Simulated run time of the input tool, which starts a JVM for every command on a real device
+        self.input_latency = input_latency
+        self.frames = list(frames)
+        # Encoded bytes served as the screenrecord output stream
+        self.video = video
+        self.frame_index = 0
+        self.commands = []
+        self._png_cache = {}
+        self._raw_cache = {}
+
+    @classmethod
+    def from_images(cls, paths, **kwargs):
+        frames = []
+        for path in paths:
+            image = cv.imread(path, cv.IMREAD_COLOR)
+            if image is None:
+                raise ValueError(f"Could not read image {path}")
+            frames.append(image)
+        return cls(frames, **kwargs)
+
+    @classmethod
+    def from_raw_dumps(cls, paths, **kwargs):
+        frames = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                pixels, pixel_format = parse_raw_framebuffer(f.read())
+            conversion = BGR_CONVERSIONS[pixel_format]
+            frames.append(pixels.copy() if conversion is None else cv.cvtColor(pixels, conversion))
+        return cls(frames, **kwargs)
+
+    @classmethod
+    def with_video(cls, frames, path, **kwargs):
+        with open(path, 'rb') as f:
+            return cls(frames, video=f.read(), **kwargs)
+
+    def _next_index(self):
+        index = self.frame_index % len(self.frames)
+        self.frame_index += 1
+        return index
+
+    def screencap(self):
+        index = self._next_index()
+        if index not in self._png_cache:
+            _, encoded = cv.imencode('.png', self.frames[index])
+            self._png_cache[index] = encoded.tobytes()
+        return self._png_cache[index]
+
+    def screencap_raw(self):
+        index = self._next_index()
+        if index not in self._raw_cache:
+            rgba = cv.cvtColor(self.frames[index], cv.COLOR_BGR2RGBA)
+            self._raw_cache[index] = encode_raw_framebuffer(rgba, pixel_format=1, dataspace=0)
+        return self._raw_cache[index]
+
+    def create_connection(self, set_transport=True, timeout=None):
+        return FakeConnection(self)
+
+    def handle_connection_command(self, command):
+        service, _, cmd = command.partition(':')
+        if re.match(r'^(/system/bin/)?screencap -p$', cmd):
+            return self.screencap()
+        if re.match(r'^(/system/bin/)?screencap$', cmd):
+            return self.screencap_raw()
+        if cmd.startswith('screenrecord') and self.video is not None:
+            self.commands.append(cmd)
+            return self.video
+        return self.shell(cmd).encode('utf-8')
+
+    def shell(self, cmd, handler=None, timeout=None):
+        self.commands.append(cmd)
+        if cmd.startswith('input ') and self.input_latency:
+            time.sleep(self.input_latency)
+        height, width = self.frames[0].shape[:2]
+        if cmd.startswith('echo '):
+            return cmd[len('echo '):].replace('"', '') + '\n'
+        if cmd == 'wm size':
+            return f"Physical size: {width}x{height}\n"
+        if cmd == 'getevent -p':
+            return ("add device 1: /dev/input/event2\n"
+                    "  name:     \"fake_touchscreen\"\n"
+                    "  events:\n"
+                    "    ABS (0003): 0035  : value 0, min 0, max 4095, fuzz 0, flat 0, resolution 0\n"
+                    "                0036  : value 0, min 0, max 4095, fuzz 0, flat 0, resolution 0\n"
+                    "                0039  : value 0, min 0, max 65535, fuzz 0, flat 0, resolution 0\n")
+        return ''
@@ -0,0 +1,113 @@
+import threading
+import time
+
+import cv2 as cv
+import numpy as np
+
+
+def decode_png(data) -> np.ndarray:
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    image = cv.imdecode(buffer, cv.IMREAD_COLOR)
+    if image is None:
+        raise ValueError("Could not decode screenshot")
+    return image
+
+
+GRAY_CONVERSIONS = {
+    'BGR': cv.COLOR_BGR2GRAY,
+    'BGRA': cv.COLOR_BGRA2GRAY,
+    'RGB': cv.COLOR_RGB2GRAY,
+    'RGBA': cv.COLOR_RGBA2GRAY,
+    'BGR565': cv.COLOR_BGR5652GRAY,
+    'GRAY': None,
+}
+
+BGR_CONVERSIONS = {
+    'BGR': None,
+    'BGRA': cv.COLOR_BGRA2BGR,
+    'RGB': cv.COLOR_RGB2BGR,
+    'RGBA': cv.COLOR_RGBA2BGR,
+    'BGR565': cv.COLOR_BGR5652BGR,
+    'GRAY': cv.COLOR_GRAY2BGR,
+}
+
+
+class Frame:
+    def __init__(self, seq, timestamp, image, pixel_format='BGR', gray=None, analysis=None):
+        self.seq = seq
+        self.timestamp = timestamp
+        self.image = image
+        self.pixel_format = pixel_format
+        # Results computed elsewhere for this frame, e.g. by the analysis pipeline
+        self.analysis = analysis
+        self._gray = gray
+        self._bgr = None
+
+    @property
+    def gray(self):
+        # Converted on first use and kept, every consumer of this frame shares it
+        if self._gray is None:
+            conversion = GRAY_CONVERSIONS[self.pixel_format]
+            self._gray = self.image if conversion is None else cv.cvtColor(self.image, conversion)
+        return self._gray
+
+    @property
+    def bgr(self):
+        if self._bgr is None:
+            conversion = BGR_CONVERSIONS[self.pixel_format]
+            self._bgr = self.image if conversion is None else cv.cvtColor(self.image, conversion)
+        return self._bgr
+
+    @property
+    def shape(self):
+        return self.image.shape[:2]
+
+
+class FrameStore:
+    def __init__(self):
+        # Two slots: the writer fills the back one and flips the index, so readers
+        # always get a complete frame without holding the lock while they use it
+        self._buffers = [None, None]
+        self._front = 0
+        self._seq = 0
+        self._condition = threading.Condition()
+        # Highest seq handed out by consume(), and how many frames were never consumed
+        self.consumed_seq = 0
+        self.dropped = 0
+
+    def publish(self, image, pixel_format='BGR', timestamp=None, gray=None, analysis=None):
+        with self._condition:
+            self._seq += 1
+            frame = Frame(self._seq, timestamp if timestamp is not None else time.time(), image, pixel_format,
+                          gray, analysis)
+            back = 1 - self._front
+            self._buffers[back] = frame
+            self._front = back
+            self._condition.notify_all()
+        return frame
+
+    def latest(self):
+        return self._buffers[self._front]
+
+    def consume(self):
+        frame = self._buffers[self._front]
+        self.mark_consumed(frame)
+        return frame
+
+    def mark_consumed(self, frame):
+        # For frames handed out some other way, e.g. by CaptureScheduler.request_frame
+        if frame is None:
+            return
+        with self._condition:
+            if frame.seq > self.consumed_seq:
+                self.dropped += frame.seq - self.consumed_seq - 1
+                self.consumed_seq = frame.seq
+
+    @property
+    def seq(self):
+        return self._seq
+
+    def wait_for_frame(self, after_seq=0, timeout=None):
+        with self._condition:
+            self._condition.wait_for(lambda: self._seq > after_seq, timeout)
+            return self._buffers[self._front]
@@ -1,4 +1,7 @@
 import os
 
+def get_images_dir() -> str:
+    return os.path.join(os.path.dirname(__file__), '..', 'images')
+
 def get_image_path(image_name: str) -> str:
-    return os.path.join(os.path.dirname(__file__), '..', 'images', image_name)
+    return os.path.join(get_images_dir(), image_name)
@@ -0,0 +1,222 @@
+import logging
+import re
+import socket
+import threading
+
+from utils.device_info import read_screen_size
+from utils.metrics import REGISTRY
+
+# Linux input event codes used by sendevent
+EV_SYN = 0
+EV_KEY = 1
+EV_ABS = 3
+BTN_TOUCH = 330
+ABS_MT_POSITION_X = 0x35
+ABS_MT_POSITION_Y = 0x36
+ABS_MT_TRACKING_ID = 0x39
+TRACKING_ID_RELEASE = 0xFFFFFFFF
+
+# Printed by the shell once every command sent before it has run. The marker command quotes the
+# number, so the shell's echo of the typed command never matches, only its output does.
+DONE_MARKER = re.compile(r'__done_(\d+)__')
+
+logger = logging.getLogger('bot.input')
+
+
+def done_command(sequence):
+    return f'echo __done_"{sequence}"__'
+
+
+def tap_command(x, y):
+    return f"input tap {x} {y}"
+
+
+def swipe_command(x1, y1, x2, y2, duration):
+    return f"input touchscreen swipe {x1} {y1} {x2} {y2} {duration}"
+
+
+class ShellInputDriver:
+    def __init__(self, device, completion_timeout=5.0):
+        self.device = device
+        self.connection = None
+        self.lock = threading.Lock()
+        self.drain_thread = None
+        # Every send ends with an echoed marker; send() returns once the shell printed it, so at
+        # most one batch is ever queued on the device
+        self.completion_timeout = completion_timeout
+        self.sequence = 0
+        self.completed = 0
+        self.completed_condition = threading.Condition()
+
+    def _open(self):
+        conn = self.device.create_connection()
+        # An empty shell: service gives an interactive shell that reads commands from the socket
+        conn.send("shell:")
+        self.connection = conn
+        self.drain_thread = threading.Thread(target=self._drain, args=(conn,), daemon=True)
+        self.drain_thread.start()
+
+    def _drain(self, conn):
+        # The shell echoes prompts and output back; keep reading so it never blocks on a full socket,
+        # and pick the completion markers out of the output
+        pending = ''
+        try:
+            while True:
+                chunk = conn.read(4096)
+                if not chunk:
+                    return
+                pending += bytes(chunk).decode('utf-8', errors='replace')
+                markers = DONE_MARKER.findall(pending)
+                if markers:
+                    with self.completed_condition:
+                        self.completed = max(self.completed, max(map(int, markers)))
+                        self.completed_condition.notify_all()
+                # Keep a tail in case a marker is split across reads
+                pending = pending[-32:]
+        except OSError:
+            pass
+
+    def send(self, commands):
+        with self.lock:
+            self.sequence += 1
+            sequence = self.sequence
+            payload = ''.join(f"{command}\n" for command in [*commands, done_command(sequence)]).encode('utf-8')
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        self._open()
+                    self.connection.write(payload)
+                    break
+                except (OSError, RuntimeError):
+                    self._close_connection()
+                    if attempt:
+                        raise
+
+            with self.completed_condition:
+                done = self.completed_condition.wait_for(lambda: self.completed >= sequence, self.completion_timeout)
+            if not done:
+                # A shell that stopped answering would hold every later tap, start over on a new one
+                logger.warning("Input shell did not finish %d commands within %.1fs, reconnecting",
+                               len(commands), self.completion_timeout)
+                self._close_connection()
+
+    def tap(self, x, y):
+        self.send(self.tap_commands(x, y))
+        REGISTRY.increment('taps')
+
+    def swipe(self, x1, y1, x2, y2, duration):
+        self.send([swipe_command(x1, y1, x2, y2, duration)])
+
+    def tap_commands(self, x, y):
+        return [tap_command(x, y)]
+
+    def batch(self):
+        return InputBatch(self)
+
+    def _close_connection(self):
+        if self.connection is None:
+            return
+        # Closing alone does not wake a recv() blocked in another thread, shutting the socket down does
+        sock = getattr(self.connection, 'socket', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        self.connection.close()
+        self.connection = None
+        if self.drain_thread is not None and self.drain_thread is not threading.current_thread():
+            self.drain_thread.join(timeout=1)
+        self.drain_thread = None
+
+    def close(self):
+        with self.lock:
+            self._close_connection()
+
+
+class SendeventInputDriver(ShellInputDriver):
+    # Writes raw multitouch events instead of starting the input tool for every tap
+    def __init__(self, device, event_device=None, axis_max=None, screen_size=None):
+        super().__init__(device)
+        self.event_device = event_device
+        self.axis_max = axis_max
+        self.screen_size = screen_size
+        self.tracking_id = 0
+        if event_device is None or axis_max is None:
+            self.event_device, self.axis_max = self.find_touchscreen()
+        if screen_size is None:
+            self.screen_size = self.read_screen_size()
+
+    def find_touchscreen(self):
+        output = self.device.shell("getevent -p")
+        for block in re.split(r'^add device \d+: ', output, flags=re.MULTILINE)[1:]:
+            path = block.split()[0]
+            x_max = re.search(r'0035\s*:.*?max (\d+)', block)
+            y_max = re.search(r'0036\s*:.*?max (\d+)', block)
+            if x_max and y_max:
+                return path, (int(x_max.group(1)), int(y_max.group(1)))
+        raise RuntimeError("No multitouch input device found in getevent -p output")
+
+    def read_screen_size(self):
+        return read_screen_size(self.device)
+
+    def _event(self, type, code, value):
+        return f"sendevent {self.event_device} {type} {code} {value}"
+
+    def tap_commands(self, x, y):
+        width, height = self.screen_size
+        x_max, y_max = self.axis_max
+        device_x = x * (x_max + 1) // width
+        device_y = y * (y_max + 1) // height
+        self.tracking_id = (self.tracking_id + 1) % 0xFFFF
+        events = [
+            self._event(EV_ABS, ABS_MT_TRACKING_ID, self.tracking_id),
+            self._event(EV_ABS, ABS_MT_POSITION_X, device_x),
+            self._event(EV_ABS, ABS_MT_POSITION_Y, device_y),
+            self._event(EV_KEY, BTN_TOUCH, 1),
+            self._event(EV_SYN, 0, 0),
+            self._event(EV_ABS, ABS_MT_TRACKING_ID, TRACKING_ID_RELEASE),
+            self._event(EV_KEY, BTN_TOUCH, 0),
+            self._event(EV_SYN, 0, 0),
+        ]
+        # One line so the down/up pair reaches the shell together
+        return [' ; '.join(events)]
+
+
+class InputBatch:
+    def __init__(self, driver):
+        self.driver = driver
+        self.commands = []
+
+    def tap(self, x, y):
+        self.commands.extend(self.driver.tap_commands(x, y))
+        REGISTRY.increment('taps')
+        return self
+
+    def swipe(self, x1, y1, x2, y2, duration):
+        self.commands.append(swipe_command(x1, y1, x2, y2, duration))
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.submit()
+
+    def submit(self):
+        if self.commands:
+            self.driver.send(self.commands)
+            self.commands = []
+
+
+INPUT_DRIVERS = {
+    'shell': ShellInputDriver,
+    'sendevent': SendeventInputDriver,
+}
+
+
+def create_input_driver(name, device):
+    if name not in INPUT_DRIVERS:
+        raise ValueError(f"Unknown input driver '{name}', expected one of {sorted(INPUT_DRIVERS)}")
+    return INPUT_DRIVERS[name](device)
@@ -0,0 +1,111 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+LOG_FORMAT = '%(asctime)s %(levelname)s %(threadName)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class StructuredFormatter(logging.Formatter):
+    # Fields passed as extra={'fields': {...}} are appended as key=value pairs
+    def format(self, record):
+        message = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            message += ' ' + ' '.join(f"{key}={value!r}" for key, value in fields.items())
+        return message
+
+
+class RateLimitFilter(logging.Filter):
+    # Lets each distinct message through at most `burst` times per `interval` seconds and
+    # reports how many copies were held back the next time it gets through
+    def __init__(self, interval=1.0, burst=10):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        key = (record.name, record.levelno, record.msg)
+        now = time.monotonic()
+        with self.lock:
+            started, count, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - started >= self.interval:
+                started, count = now, 0
+            if count >= self.burst:
+                self.windows[key] = (started, count, suppressed + 1)
+                return False
+            self.windows[key] = (started, count + 1, 0)
+
+        if suppressed:
+            record.fields = dict(getattr(record, 'fields', None) or {}, suppressed=suppressed)
+        return True
+
+
+class BoundedQueueHandler(logging.handlers.QueueHandler):
+    # Drops records instead of blocking the caller when the writer thread falls behind
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Formatting is left to the writer thread; the record's args are kept as they are
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogWriter:
+    def __init__(self, handler, listener, file_handler):
+        self.handler = handler
+        self.listener = listener
+        self.file_handler = file_handler
+
+    @property
+    def dropped(self):
+        return self.handler.dropped
+
+    def stop(self):
+        # Safe to call again, e.g. by a later setup_logging after the bot already stopped its writer
+        if self.listener._thread is None:
+            return
+        logging.getLogger().removeHandler(self.handler)
+        self.listener.stop()
+        self.file_handler.close()
+
+
+_active_writer = None
+_active_lock = threading.Lock()
+
+
+def setup_logging(log_file, level=logging.INFO, max_bytes=5 * 1024 * 1024, backup_count=3, queue_size=10000,
+                  rate_interval=1.0, rate_burst=10):
+    # Root logger records go through a bounded queue to a rotating file written on a background
+    # thread. Calling it again replaces the previous setup, like logging.basicConfig(force=True).
+    global _active_writer
+
+    file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backup_count,
+                                                        delay=True)
+    file_handler.setFormatter(StructuredFormatter(LOG_FORMAT, DATE_FORMAT))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    handler = BoundedQueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(rate_interval, rate_burst))
+    listener = logging.handlers.QueueListener(log_queue, file_handler)
+
+    with _active_lock:
+        if _active_writer is not None:
+            _active_writer.stop()
+        root = logging.getLogger()
+        root.addHandler(handler)
+        root.setLevel(level)
+        listener.start()
+        _active_writer = LogWriter(handler, listener, file_handler)
+        return _active_writer
@@ -0,0 +1,167 @@
+import cv2 as cv
+
+# How far around the last match location the first search looks, in pixels
+DEFAULT_WINDOW_MARGIN = 24
+
+# Coarse pass of the pyramid: candidates scoring below this at 1/4 scale are
+# rejected without a full resolution match. It sits well under the final
+# threshold so the downscaling blur does not turn real matches into misses.
+COARSE_THRESHOLD = 0.45
+COARSE_CANDIDATES = 3
+# Smaller searches than this many template areas are cheaper to do at full scale
+MIN_PYRAMID_AREA_RATIO = 16
+MIN_COARSE_TEMPLATE_SIDE = 8
+# A search area this flat cannot correlate with anything, TM_CCOEFF_NORMED is 0 there
+FLAT_STDDEV = 1.0
+
+
+def clip_region(region, shape):
+    height, width = shape[:2]
+    x1, y1, x2, y2 = region
+    return max(0, x1), max(0, y1), min(width, x2), min(height, y2)
+
+
+class MatchStats:
+    def __init__(self):
+        self.window_hits = 0
+        self.region_hits = 0
+        self.misses = 0
+        self.coarse_rejections = 0
+        self.pixels_searched = 0
+        self.calls = 0
+
+    def as_dict(self):
+        lookups = self.window_hits + self.region_hits
+        return {
+            'calls': self.calls,
+            'window_hits': self.window_hits,
+            'region_hits': self.region_hits,
+            'misses': self.misses,
+            'coarse_rejections': self.coarse_rejections,
+            'window_hit_rate': self.window_hits / lookups if lookups else 0.0,
+            'avg_pixels_searched': self.pixels_searched / self.calls if self.calls else 0,
+        }
+
+
+class TemplateMatcher:
+    def __init__(self, registry, window_margin=DEFAULT_WINDOW_MARGIN, use_pyramid=True):
+        self.registry = registry
+        self.window_margin = window_margin
+        self.use_pyramid = use_pyramid
+        # Template name -> top left corner of the last successful match
+        self.last_locations = {}
+        self.stats = {name: MatchStats() for name in registry.names()}
+        # The downscaled frame is shared by every template matched against it
+        self._pyramid_source = None
+        self._pyramid_small = None
+
+    def _small_frame(self, mat, factor):
+        if self._pyramid_source is not mat:
+            self._pyramid_small = cv.resize(mat, (mat.shape[1] // factor, mat.shape[0] // factor),
+                                            interpolation=cv.INTER_AREA)
+            self._pyramid_source = mat
+        return self._pyramid_small
+
+    def _search_exhaustive(self, mat, template, x1, y1, x2, y2):
+        result = cv.matchTemplate(mat[y1:y2, x1:x2], template.gray, cv.TM_CCOEFF_NORMED)
+        _, max_val, _, max_loc = cv.minMaxLoc(result)
+        return max_val, (max_loc[0] + x1, max_loc[1] + y1)
+
+    def _coarse_candidates(self, mat, template, x1, y1, x2, y2):
+        factor = template.downscale
+        small = self._small_frame(mat, factor)
+        sx1, sy1, sx2, sy2 = x1 // factor, y1 // factor, x2 // factor, y2 // factor
+        search = small[sy1:sy2, sx1:sx2]
+        small_height, small_width = template.small.shape[:2]
+        if search.shape[0] < small_height or search.shape[1] < small_width:
+            return []
+
+        _, stddev = cv.meanStdDev(search)
+        if stddev[0][0] < FLAT_STDDEV:
+            return []
+
+        result = cv.matchTemplate(search, template.small, cv.TM_CCOEFF_NORMED)
+        candidates = []
+        for _ in range(COARSE_CANDIDATES):
+            _, max_val, _, max_loc = cv.minMaxLoc(result)
+            if max_val < COARSE_THRESHOLD:
+                break
+            candidates.append(((max_loc[0] + sx1) * factor, (max_loc[1] + sy1) * factor))
+            # Suppress this peak so the next candidate is a different location
+            cx, cy = max_loc
+            result[max(0, cy - small_height // 2):cy + small_height // 2 + 1,
+                   max(0, cx - small_width // 2):cx + small_width // 2 + 1] = -1.0
+        return candidates
+
+    def _search(self, mat, template, region):
+        x1, y1, x2, y2 = clip_region(region, mat.shape)
+        if x2 - x1 < template.width or y2 - y1 < template.height:
+            return -1.0, None, 0
+
+        searched = (x2 - x1) * (y2 - y1)
+        small_side = min(template.small.shape[:2])
+        if (not self.use_pyramid or small_side < MIN_COARSE_TEMPLATE_SIDE
+                or searched < MIN_PYRAMID_AREA_RATIO * template.width * template.height):
+            max_val, location = self._search_exhaustive(mat, template, x1, y1, x2, y2)
+            return max_val, location, searched
+
+        # Coarse to fine: refine each coarse candidate at full resolution in a
+        # window covering the rounding error of the downscale
+        best_val, best_location = -1.0, None
+        searched //= template.downscale ** 2
+        slack = 2 * template.downscale
+        for cx, cy in self._coarse_candidates(mat, template, x1, y1, x2, y2):
+            wx1, wy1 = max(x1, cx - slack), max(y1, cy - slack)
+            wx2, wy2 = min(x2, cx + template.width + slack), min(y2, cy + template.height + slack)
+            if wx2 - wx1 < template.width or wy2 - wy1 < template.height:
+                continue
+            max_val, location = self._search_exhaustive(mat, template, wx1, wy1, wx2, wy2)
+            searched += (wx2 - wx1) * (wy2 - wy1)
+            if max_val > best_val:
+                best_val, best_location = max_val, location
+
+        if best_location is None:
+            self.stats[template.name].coarse_rejections += 1
+            return -1.0, (x1, y1), searched
+        return best_val, best_location, searched
+
+    def _window(self, template, location):
+        x, y = location
+        margin = self.window_margin
+        return x - margin, y - margin, x + template.width + margin, y + template.height + margin
+
+    def match(self, mat, name):
+        template = self.registry.get(name)
+        stats = self.stats[name]
+        stats.calls += 1
+
+        last_location = self.last_locations.get(name)
+        if last_location is not None:
+            score, location, searched = self._search(mat, template, self._window(template, last_location))
+            stats.pixels_searched += searched
+            if score >= template.threshold:
+                stats.window_hits += 1
+                self.last_locations[name] = location
+                return template.center(location), score
+
+        # The expected region is the whole space the template may appear in, so a
+        # miss there is final; templates without one fall back to the full frame
+        region = template.region or (0, 0, mat.shape[1], mat.shape[0])
+        score, location, searched = self._search(mat, template, region)
+        stats.pixels_searched += searched
+        if location is None or score < template.threshold:
+            stats.misses += 1
+            return None, score
+
+        stats.region_hits += 1
+        self.last_locations[name] = location
+        return template.center(location), score
+
+    def forget(self, name=None):
+        if name is None:
+            self.last_locations.clear()
+        else:
+            self.last_locations.pop(name, None)
+
+    def stats_summary(self):
+        return {name: stats.as_dict() for name, stats in self.stats.items()}
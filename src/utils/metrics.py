@@ -0,0 +1,248 @@
+import bisect
+import json
+import os
+import threading
+import time
+import weakref
+
+# Upper bounds of the latency buckets in milliseconds, roughly three per decade
+BUCKETS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum_ms = 0.0
+
+    def observe(self, milliseconds):
+        self.counts[bisect.bisect_left(self.buckets, milliseconds)] += 1
+        self.count += 1
+        self.sum_ms += milliseconds
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.sum_ms += other.sum_ms
+
+    def percentile(self, fraction):
+        # Upper bound of the bucket holding the requested rank, good enough to see where time goes
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound if bound != float('inf') else self.buckets[-2]
+        return self.buckets[-2]
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'mean_ms': self.sum_ms / self.count if self.count else 0.0,
+            'p50_ms': self.percentile(0.5),
+            'p95_ms': self.percentile(0.95),
+            'p99_ms': self.percentile(0.99),
+        }
+
+
+class Span:
+    __slots__ = ('shard', 'key', 'start')
+
+    def __init__(self, shard, key):
+        self.shard = shard
+        self.key = key
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.shard.observe(self.key, (time.perf_counter() - self.start) * 1000)
+
+
+class Shard:
+    # Only its own thread writes to a shard, so recording takes no lock
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, key, milliseconds):
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(milliseconds)
+
+    def increment(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def merge(self, other):
+        for key, histogram in other.histograms.items():
+            self.histograms.setdefault(key, Histogram()).merge(histogram)
+        for name, value in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + value
+
+
+class _ShardOwner:
+    # Lives in the thread's local storage; it is collected when the thread ends
+    __slots__ = ('shard', '__weakref__')
+
+    def __init__(self, shard):
+        self.shard = shard
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []
+        # What threads that have ended recorded, folded together so dead threads cost nothing
+        self.retired = Shard()
+        self.shards_lock = threading.Lock()
+        self.started = time.monotonic()
+
+    def _shard(self):
+        owner = getattr(self.local, 'owner', None)
+        if owner is None:
+            owner = self.local.owner = _ShardOwner(Shard())
+            with self.shards_lock:
+                self.shards.append(owner.shard)
+            weakref.finalize(owner, self._retire, owner.shard)
+        return owner.shard
+
+    def _retire(self, shard):
+        with self.shards_lock:
+            self.shards.remove(shard)
+            self.retired.merge(shard)
+
+    def span(self, name, label=None):
+        return Span(self._shard(), (name, label))
+
+    def observe(self, name, seconds, label=None):
+        self._shard().observe((name, label), seconds * 1000)
+
+    def increment(self, name, amount=1):
+        self._shard().increment(name, amount)
+
+    def snapshot(self):
+        # Readers merge the shards; a record landing mid-merge shows up in the next snapshot
+        with self.shards_lock:
+            shards = list(self.shards)
+            retired = Shard()
+            retired.merge(self.retired)
+        histograms, counters = {}, {}
+        for shard in [retired, *shards]:
+            for key, histogram in list(shard.histograms.items()):
+                histograms.setdefault(key, Histogram()).merge(histogram)
+            for name, value in list(shard.counters.items()):
+                counters[name] = counters.get(name, 0) + value
+        return MetricsSnapshot(time.monotonic(), time.monotonic() - self.started, histograms, counters)
+
+
+class MetricsSnapshot:
+    def __init__(self, timestamp, uptime, histograms, counters):
+        self.timestamp = timestamp
+        self.uptime = uptime
+        self.histograms = histograms
+        self.counters = counters
+
+    def histogram(self, name, label=None):
+        # label=None merges every label of the span, e.g. all templates of analyze_image
+        if label is not None:
+            return self.histograms.get((name, label), Histogram())
+        merged = Histogram()
+        for (key_name, _), histogram in self.histograms.items():
+            if key_name == name:
+                merged.merge(histogram)
+        return merged
+
+    def rate(self, name, previous=None):
+        # Per second since the previous snapshot, or over the whole uptime without one
+        elapsed = self.timestamp - previous.timestamp if previous else self.uptime
+        if elapsed <= 0:
+            return 0.0
+        delta = self.counters.get(name, 0) - (previous.counters.get(name, 0) if previous else 0)
+        return delta / elapsed
+
+    def to_dict(self, previous=None):
+        return {
+            'uptime_seconds': self.uptime,
+            'counters': dict(self.counters),
+            'rates_per_second': {name: self.rate(name, previous) for name in self.counters},
+            'histograms': {f"{name}[{label}]" if label is not None else name: histogram.summary()
+                           for (name, label), histogram in sorted(self.histograms.items(), key=str)},
+        }
+
+    def to_prometheus(self, prefix='bot'):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+
+        names = sorted({name for name, _ in self.histograms})
+        for name in names:
+            metric = f"{prefix}_{name}_milliseconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for (key_name, label), histogram in sorted(self.histograms.items(), key=str):
+                if key_name != name:
+                    continue
+                labels = f'span="{label}",' if label is not None else ''
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else f"{bound:g}"
+                    lines.append(f'{metric}_bucket{{{labels}le="{le}"}} {cumulative}')
+                label_set = f"{{{labels.rstrip(',')}}}" if labels else ''
+                lines.append(f"{metric}_sum{label_set} {histogram.sum_ms:.3f}")
+                lines.append(f"{metric}_count{label_set} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsExporter:
+    # Rewrites the metrics file every interval, as Prometheus text or JSON picked by the extension
+    def __init__(self, registry, path, interval=10.0):
+        self.registry = registry
+        self.path = path
+        self.interval = interval
+        self.format = 'json' if path.endswith('.json') else 'prometheus'
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.previous = None
+
+    def export(self):
+        snapshot = self.registry.snapshot()
+        if self.format == 'json':
+            content = json.dumps(snapshot.to_dict(self.previous), indent=2)
+        else:
+            content = snapshot.to_prometheus()
+        self.previous = snapshot
+
+        # Written to a temporary file first so a scraper never reads half a file
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w') as f:
+            f.write(content)
+        os.replace(temporary_path, self.path)
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            try:
+                self.export()
+            except OSError:
+                pass
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=1)
+        self.export()
+
+
+# Process-wide registry; fleet workers are separate processes and each get their own
+REGISTRY = MetricsRegistry()
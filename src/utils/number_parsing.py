@@ -0,0 +1,31 @@
+import re
+
+SUFFIX_MULTIPLIERS = (('m', 1000000), ('b', 1000000000), ('k', 1000))
+
+
+def parse_number_text(text):
+    # Remove all non-alphanumeric characters except '.' and spaces
+    cleaned_text = re.sub(r'[^0-9a-zA-Z.\s]', '', text)
+
+    # Find the first word that starts with a digit
+    number_word = next((word for word in cleaned_text.split() if word[0].isdigit()), None)
+
+    if not number_word:
+        return 0
+
+    # Extract only digits and decimal point
+    clean_digits = ''.join(filter(lambda x: x.isdigit() or x == '.', number_word))
+
+    # Handle cases where the decimal point might be misread
+    if clean_digits.count('.') > 1:
+        clean_digits = clean_digits.replace('.', '', clean_digits.count('.') - 1)
+
+    amount = float(clean_digits)
+
+    # Check for suffixes in the original text
+    lower_text = text.lower()
+    for suffix, multiplier in SUFFIX_MULTIPLIERS:
+        if suffix in lower_text:
+            return amount * multiplier
+
+    return amount
@@ -0,0 +1,60 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import cv2 as cv
+import numpy as np
+
+from utils.digit_ocr import binarize
+
+# Size of the thumbnail the perceptual key is computed from
+PERCEPTUAL_SIZE = (48, 12)
+
+
+class OCRCache:
+    def __init__(self, max_size=256, perceptual=False):
+        self.max_size = max_size
+        self.perceptual = perceptual
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, region, crop):
+        binary = binarize(crop)
+        if self.perceptual:
+            # A coarse thumbnail of the binarised crop, so single pixel
+            # anti-aliasing differences map to the same key
+            thumbnail = cv.resize(binary, PERCEPTUAL_SIZE, interpolation=cv.INTER_AREA)
+            binary = np.where(thumbnail >= 128, 255, 0).astype(np.uint8)
+        digest = hashlib.blake2b(np.packbits(binary).tobytes(), digest_size=16).digest()
+        return region, binary.shape, digest
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
@@ -0,0 +1,235 @@
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from dataclasses import dataclass, field
+from multiprocessing import shared_memory
+from typing import Optional
+
+import cv2 as cv
+import numpy as np
+
+from utils.capture import CAPTURE_BACKENDS
+from utils.frame_store import BGR_CONVERSIONS, Frame
+from utils.metrics import REGISTRY
+from utils.screen_state import (BUY_COINS_TEMPLATE, CLOSE_BATTLE_TEMPLATE, IN_BATTLE_TEMPLATE, MENU_TEMPLATE,
+                                STUCK_TEMPLATE)
+
+# Templates the state machine decides on, matched on every frame when no candidates are given
+PIPELINE_TEMPLATES = (IN_BATTLE_TEMPLATE, MENU_TEMPLATE, CLOSE_BATTLE_TEMPLATE, STUCK_TEMPLATE, BUY_COINS_TEMPLATE)
+
+# Room for encoded screenshots larger than the raw pixels, PNG of a noisy screen can get there
+SLOT_MARGIN = 64 * 1024
+
+logger = logging.getLogger('bot.pipeline')
+
+
+@dataclass(frozen=True)
+class FrameAnalysis:
+    capture_seq: int
+    timestamp: float
+    slot: int
+    shape: tuple = ()
+    # Template name -> center or None
+    matches: dict = field(default_factory=dict)
+    # OCR region name -> value, None where the glyph OCR was not confident
+    numbers: dict = field(default_factory=dict)
+    decode_ms: float = 0.0
+    analyze_ms: float = 0.0
+    error: Optional[str] = None
+
+
+def analysis_worker(frames_name, slot_size, templates_name, manifest, backend_name, ocr_regions, tasks, results):
+    # Imported here so the spawned interpreter only pays for them in the worker
+    from utils.digit_ocr import DigitOCR
+    from utils.matcher import TemplateMatcher
+    from utils.screen_state import ScreenClassifier
+    from utils.templates import TemplateRegistry, attach_shared_memory
+
+    registry = TemplateRegistry.from_shared(templates_name, manifest)
+    classifier = ScreenClassifier(TemplateMatcher(registry))
+    digit_ocr = DigitOCR()
+    decode = CAPTURE_BACKENDS[backend_name].decode
+    block = attach_shared_memory(frames_name)
+
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            slot, capture_seq, timestamp, length, template_names = task
+            offset = slot * slot_size
+            try:
+                start = time.perf_counter()
+                payload = block.buf[offset:offset + length]
+                image, pixel_format = decode(payload)
+                conversion = BGR_CONVERSIONS[pixel_format]
+                bgr = image if conversion is None else cv.cvtColor(image, conversion)
+                gray = cv.cvtColor(bgr, cv.COLOR_BGR2GRAY)
+                del image, payload
+                decoded = time.perf_counter()
+
+                # The decoded pixels replace the payload in the slot, gray right after the colour planes
+                height, width = gray.shape
+                np.ndarray((height, width, 3), dtype=np.uint8, buffer=block.buf, offset=offset)[:] = bgr
+                np.ndarray((height, width), dtype=np.uint8, buffer=block.buf,
+                           offset=offset + bgr.nbytes)[:] = gray
+
+                frame = Frame(capture_seq, timestamp, bgr, 'BGR', gray=gray)
+                matches = {name: classifier.find(frame, name) for name in template_names}
+
+                numbers = {}
+                # Nothing is read off the screen during a battle, skip the OCR there
+                if matches.get(IN_BATTLE_TEMPLATE) is None:
+                    for name, (x1, y1, x2, y2) in ocr_regions.items():
+                        numbers[name], _ = digit_ocr.read(gray[y1:y2, x1:x2])
+
+                results.put(FrameAnalysis(capture_seq, timestamp, slot, (height, width), matches, numbers,
+                                          (decoded - start) * 1000, (time.perf_counter() - decoded) * 1000))
+            except Exception as e:
+                results.put(FrameAnalysis(capture_seq, timestamp, slot, error=repr(e)))
+    finally:
+        block.close()
+
+
+class AnalysisPipeline:
+    # capture -> decode -> classify -> OCR, with everything after the capture in worker processes.
+    # Frames travel through shared memory slots; only slot numbers and results are pickled. The
+    # stages after the capture share a worker on purpose: each needs the decoded frame, handing it
+    # on to another process would cost a copy and a queue hop per frame for no extra parallelism,
+    # since whole frames are already spread over the workers.
+    def __init__(self, capture, templates, frame_shape, workers=None, ocr_regions=None, on_result=None,
+                 queue_depth=2, candidates=None):
+        self.capture = capture
+        self.templates = templates
+        # candidates() names the templates worth matching on the next frame, e.g. what the current
+        # state can tell apart; asked at capture time so a state change applies from the next frame
+        self.candidates = candidates or (lambda: PIPELINE_TEMPLATES)
+        self.workers = workers or max(1, (os.cpu_count() or 2) - 1)
+        self.ocr_regions = dict(ocr_regions or {})
+        self.on_result = on_result
+
+        height, width = frame_shape[:2]
+        # Big enough for a 4 byte per pixel raw screencap, and later for the BGR and gray planes
+        self.slot_size = height * width * 4 + SLOT_MARGIN
+        self.slot_count = self.workers * queue_depth + 2
+        self.context = multiprocessing.get_context('spawn')
+        self.tasks = self.context.Queue(maxsize=self.workers * queue_depth)
+        self.results = self.context.Queue()
+        self.free_slots = queue.Queue()
+        for slot in range(self.slot_count):
+            self.free_slots.put(slot)
+
+        self.frames_block = None
+        self.templates_block = None
+        self.processes = []
+        self.collector = None
+        self.capture_seq = 0
+        self.published_seq = 0
+        self.submitted = 0
+        self.skipped = 0
+        self.stale = 0
+        self.errors = 0
+
+    def start(self):
+        self.frames_block = shared_memory.SharedMemory(create=True, size=self.slot_size * self.slot_count)
+        self.templates_block, manifest = self.templates.export_shared()
+        for _ in range(self.workers):
+            process = self.context.Process(
+                target=analysis_worker, daemon=True,
+                args=(self.frames_block.name, self.slot_size, self.templates_block.name, manifest,
+                      self.capture.name, self.ocr_regions, self.tasks, self.results))
+            process.start()
+            self.processes.append(process)
+        self.collector = threading.Thread(target=self._collect, daemon=True)
+        self.collector.start()
+        return self
+
+    def submit(self):
+        # Capture stage, runs on the capture scheduler's thread; returns None when no slot is free
+        try:
+            slot = self.free_slots.get_nowait()
+        except queue.Empty:
+            self.skipped += 1
+            return None
+
+        try:
+            with REGISTRY.span('screencap', self.capture.name):
+                data = self.capture.grab()
+            if len(data) > self.slot_size:
+                raise ValueError(f"Screenshot of {len(data)} bytes does not fit a {self.slot_size} byte slot")
+            offset = slot * self.slot_size
+            self.frames_block.buf[offset:offset + len(data)] = data
+        except Exception:
+            self.free_slots.put(slot)
+            raise
+
+        self.capture_seq += 1
+        self.tasks.put((slot, self.capture_seq, time.time(), len(data), tuple(self.candidates())))
+        self.submitted += 1
+        return self.capture_seq
+
+    def _collect(self):
+        while True:
+            analysis = self.results.get()
+            if analysis is None:
+                return
+            try:
+                self._handle(analysis)
+            finally:
+                self.free_slots.put(analysis.slot)
+
+    def _handle(self, analysis):
+        if analysis.error:
+            self.errors += 1
+            logger.warning("Pipeline failed on frame %d: %s", analysis.capture_seq, analysis.error)
+            return
+        # Workers finish out of order, a frame older than the one already published is useless
+        if analysis.capture_seq <= self.published_seq:
+            self.stale += 1
+            return
+        self.published_seq = analysis.capture_seq
+
+        REGISTRY.observe('pipeline_decode', analysis.decode_ms / 1000)
+        REGISTRY.observe('pipeline_analyze', analysis.analyze_ms / 1000)
+
+        # Copied out so the slot can be reused while the bot still holds the frame
+        height, width = analysis.shape
+        offset = analysis.slot * self.slot_size
+        image = np.ndarray((height, width, 3), dtype=np.uint8, buffer=self.frames_block.buf, offset=offset).copy()
+        gray = np.ndarray((height, width), dtype=np.uint8, buffer=self.frames_block.buf,
+                          offset=offset + image.nbytes).copy()
+        if self.on_result:
+            self.on_result(image, gray, analysis)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'submitted': self.submitted,
+            'in_flight': self.slot_count - self.free_slots.qsize(),
+            'skipped': self.skipped,
+            'stale': self.stale,
+            'errors': self.errors,
+        }
+
+    def stop(self):
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=2)
+            if process.is_alive():
+                process.terminate()
+        self.processes = []
+
+        if self.collector is not None:
+            self.results.put(None)
+            self.collector.join(timeout=2)
+            self.collector = None
+
+        for block in (self.frames_block, self.templates_block):
+            if block is not None:
+                block.close()
+                block.unlink()
+        self.frames_block = self.templates_block = None
@@ -0,0 +1,34 @@
+from utils.change_tracker import ChangeTracker
+
+IN_BATTLE_TEMPLATE = 'is-in-battle.png'
+MENU_TEMPLATE = 'market-menu-button.png'
+CLOSE_BATTLE_TEMPLATE = 'close-battle-button.png'
+STUCK_TEMPLATE = 'are-you-stuck-button.png'
+BUY_COINS_TEMPLATE = 'close_buy_coins.png'
+
+
+class ScreenClassifier:
+    def __init__(self, matcher, change_tracker=None):
+        self.matcher = matcher
+        self.change_tracker = change_tracker or ChangeTracker()
+        # Template name -> (seq of the frame it was matched on, center or None)
+        self._results = {}
+        self.templates_skipped = 0
+        self.templates_matched = 0
+
+    def find(self, frame, name):
+        self.change_tracker.update(frame)
+
+        # Reuse the last result while no tile the template could be found in has changed
+        result = self._results.get(name)
+        if result is not None:
+            seq, center = result
+            region = self.matcher.registry.get(name).region
+            if seq <= frame.seq and not self.change_tracker.changed_since(seq, region):
+                self.templates_skipped += 1
+                return center
+
+        center, _ = self.matcher.match(frame.gray, name)
+        self._results[name] = (frame.seq, center)
+        self.templates_matched += 1
+        return center
@@ -0,0 +1,280 @@
+import json
+import re
+import struct
+import threading
+import time
+import zlib
+
+import cv2 as cv
+import numpy as np
+
+from utils.capture import parse_raw_framebuffer
+from utils.fake_device import FakeDevice
+from utils.frame_store import BGR_CONVERSIONS, decode_png
+
+SESSION_MAGIC = b'ADBSESS1'
+
+# Record kinds; every record is kind, seconds since the session started and payload length
+KEYFRAME = b'K'
+DELTA = b'D'
+SHELL = b'S'
+INPUT = b'I'
+RECORD_HEADER = struct.Struct('<cdI')
+FRAME_HEADER = struct.Struct('<HHB')
+# Capture pace assumed for sessions with a single frame
+DEFAULT_FRAME_INTERVAL = 0.05
+
+
+class SessionWriter:
+    # Level 1 keeps compression cheap enough to run on the capture thread while recording
+    def __init__(self, path, metadata=None, level=1):
+        self.file = open(path, 'wb')
+        self.level = level
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        self.previous = None
+        self.frames = 0
+        encoded = json.dumps(metadata or {}).encode('utf-8')
+        self.file.write(SESSION_MAGIC + struct.pack('<I', len(encoded)) + encoded)
+
+    def _write(self, kind, payload, timestamp):
+        if timestamp is None:
+            timestamp = time.monotonic() - self.started
+        self.file.write(RECORD_HEADER.pack(kind, timestamp, len(payload)) + payload)
+
+    def write_frame(self, image, timestamp=None):
+        image = np.ascontiguousarray(image)
+        height, width = image.shape[:2]
+        channels = image.shape[2] if image.ndim == 3 else 1
+        header = FRAME_HEADER.pack(height, width, channels)
+        with self.lock:
+            keyframe = zlib.compress(image.tobytes(), self.level)
+            kind, payload = KEYFRAME, keyframe
+            # Consecutive screens are mostly identical, so the XOR against the previous frame is mostly zeros
+            if self.previous is not None and self.previous.shape == image.shape:
+                delta = zlib.compress(np.bitwise_xor(image, self.previous).tobytes(), self.level)
+                if len(delta) < len(keyframe):
+                    kind, payload = DELTA, delta
+            self._write(kind, header + payload, timestamp)
+            self.previous = image.copy()
+            self.frames += 1
+
+    def write_shell(self, cmd, output, timestamp=None):
+        payload = json.dumps({'cmd': cmd, 'output': output}).encode('utf-8')
+        with self.lock:
+            self._write(SHELL, payload, timestamp)
+
+    def write_input(self, command, timestamp=None):
+        with self.lock:
+            self._write(INPUT, command.encode('utf-8'), timestamp)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Session:
+    def __init__(self, metadata, frames, frame_times, shell_outputs, inputs):
+        self.metadata = metadata
+        self.frames = frames
+        self.frame_times = frame_times
+        # Last recorded output per command, what a replayed shell() answers
+        self.shell_outputs = shell_outputs
+        # (timestamp, command) for every input line the recorded bot sent
+        self.inputs = inputs
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        if not data.startswith(SESSION_MAGIC):
+            raise ValueError(f"{path} is not a session file")
+
+        offset = len(SESSION_MAGIC)
+        (metadata_length,) = struct.unpack_from('<I', data, offset)
+        offset += 4
+        metadata = json.loads(data[offset:offset + metadata_length])
+        offset += metadata_length
+
+        frames, frame_times, shell_outputs, inputs = [], [], {}, []
+        previous = None
+        while offset < len(data):
+            kind, timestamp, length = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            payload = data[offset:offset + length]
+            offset += length
+
+            if kind in (KEYFRAME, DELTA):
+                height, width, channels = FRAME_HEADER.unpack_from(payload)
+                shape = (height, width, channels) if channels > 1 else (height, width)
+                pixels = np.frombuffer(zlib.decompress(payload[FRAME_HEADER.size:]), dtype=np.uint8).reshape(shape)
+                image = pixels if kind == KEYFRAME else np.bitwise_xor(pixels, previous)
+                frames.append(image)
+                frame_times.append(timestamp)
+                previous = image
+            elif kind == SHELL:
+                record = json.loads(payload)
+                shell_outputs[record['cmd']] = record['output']
+            elif kind == INPUT:
+                inputs.append((timestamp, payload.decode('utf-8')))
+            else:
+                raise ValueError(f"Unknown session record {kind!r} in {path}")
+
+        return cls(metadata, frames, frame_times, shell_outputs, inputs)
+
+
+def _to_bgr(image, pixel_format):
+    conversion = BGR_CONVERSIONS[pixel_format]
+    return image if conversion is None else cv.cvtColor(image, conversion)
+
+
+class RecordingConnection:
+    def __init__(self, connection, writer):
+        self.connection = connection
+        self.writer = writer
+        self.command = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self.connection, name)
+
+    def send(self, msg):
+        self.command = msg
+        return self.connection.send(msg)
+
+    def read_all(self):
+        data = self.connection.read_all()
+        cmd = (self.command or '').partition(':')[2]
+        if re.match(r'^(/system/bin/)?screencap -p$', cmd):
+            self.writer.write_frame(decode_png(bytes(data)))
+        elif re.match(r'^(/system/bin/)?screencap$', cmd):
+            pixels, pixel_format = parse_raw_framebuffer(bytes(data))
+            self.writer.write_frame(_to_bgr(pixels, pixel_format))
+        return data
+
+    def write(self, data):
+        # Only the interactive shell: connection is written to, one input command per line next to
+        # the input driver's completion markers
+        for line in data.decode('utf-8').splitlines():
+            if line.startswith('input ') or line.startswith('sendevent '):
+                self.writer.write_input(line.strip())
+        return self.connection.write(data)
+
+    def close(self):
+        self.connection.close()
+
+
+# Wraps a ppadb device and records every frame it returns and every command sent to it
+class RecordingDevice:
+    def __init__(self, device, path):
+        self.device = device
+        self.writer = SessionWriter(path, metadata={'serial': device.serial, 'recorded_at': time.time()})
+
+    def __getattr__(self, name):
+        return getattr(self.device, name)
+
+    def screencap(self):
+        data = self.device.screencap()
+        self.writer.write_frame(decode_png(bytes(data)))
+        return data
+
+    def shell(self, cmd, handler=None, timeout=None):
+        if handler is not None:
+            return self.device.shell(cmd, handler=handler, timeout=timeout)
+        output = self.device.shell(cmd, timeout=timeout)
+        if cmd.startswith('input ') or cmd.startswith('sendevent '):
+            self.writer.write_input(cmd)
+        else:
+            self.writer.write_shell(cmd, output)
+        return output
+
+    def create_connection(self, set_transport=True, timeout=None):
+        return RecordingConnection(self.device.create_connection(set_transport, timeout), self.writer)
+
+    def close(self):
+        self.writer.close()
+
+
+# Serves a recorded session through the same calls GameAutomation makes on a ppadb device.
+# With speed=None every capture steps to the next frame and clock() reads the recorded time of
+# the frames served so far, so a replay runs as fast as the bot can consume frames and makes the
+# same decisions every time; with a speed the frames follow the recorded timestamps on a scaled
+# wall clock.
+class ReplayDevice(FakeDevice):
+    def __init__(self, session, speed=None, serial=None):
+        super().__init__(session.frames, serial=serial or session.metadata.get('serial', 'replay'))
+        self.session = session
+        self.speed = speed
+        self.started = None
+        times = session.frame_times
+        # Captures past the end of the recording keep the clock moving at the recorded pace
+        interval = (times[-1] - times[0]) / (len(times) - 1) if len(times) > 1 else 0.0
+        self.frame_interval = interval if interval > 0 else DEFAULT_FRAME_INTERVAL
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        return cls(Session.load(path), **kwargs)
+
+    @property
+    def finished(self):
+        if self.speed is None:
+            return self.frame_index >= len(self.frames)
+        return self.started is not None and self._clock() > self.session.frame_times[-1]
+
+    def _clock(self):
+        return (time.monotonic() - self.started) * self.speed + self.session.frame_times[0]
+
+    def clock(self):
+        # Seconds on the recording's timeline
+        times = self.session.frame_times
+        if self.speed is not None:
+            return self._clock() if self.started is not None else times[0]
+        if self.frame_index == 0:
+            return times[0]
+        if self.frame_index <= len(times):
+            return times[self.frame_index - 1]
+        return times[-1] + (self.frame_index - len(times)) * self.frame_interval
+
+    def _next_index(self):
+        if self.speed is None:
+            # The last frame stays on screen once the recording runs out
+            index = min(self.frame_index, len(self.frames) - 1)
+            self.frame_index += 1
+            return index
+
+        if self.started is None:
+            self.started = time.monotonic()
+        self.frame_index = max(int(np.searchsorted(self.session.frame_times, self._clock(), side='right')) - 1, 0)
+        return self.frame_index
+
+    def shell(self, cmd, handler=None, timeout=None):
+        if cmd in self.session.shell_outputs:
+            self.commands.append(cmd)
+            return self.session.shell_outputs[cmd]
+        return super().shell(cmd, handler, timeout)
+
+    def input_commands(self):
+        return [command for command in self.commands
+                if command.startswith('input ') or command.startswith('sendevent ')]
+
+
+def session_from_images(paths, path, repeat=1, interval=0.05, shell_outputs=None):
+    # Builds a session out of still screenshots, each shown for `repeat` captures
+    writer = SessionWriter(path, metadata={'serial': 'fixture', 'sources': [str(p) for p in paths]}, level=9)
+    timestamp = 0.0
+    for image_path in paths:
+        image = cv.imread(str(image_path), cv.IMREAD_COLOR)
+        if image is None:
+            raise ValueError(f"Could not read image {image_path}")
+        for _ in range(repeat):
+            writer.write_frame(image, timestamp)
+            timestamp += interval
+    for cmd, output in (shell_outputs or {}).items():
+        writer.write_shell(cmd, output, 0.0)
+    writer.close()
+    return writer.frames
@@ -0,0 +1,146 @@
+import time
+from collections import defaultdict, deque
+
+from utils.screen_state import (BUY_COINS_TEMPLATE, CLOSE_BATTLE_TEMPLATE, IN_BATTLE_TEMPLATE, MENU_TEMPLATE,
+                                STUCK_TEMPLATE)
+
+UNKNOWN = 'unknown'
+
+
+class InvalidTransition(ValueError):
+    pass
+
+# Each state lists the templates that tell its successors apart, checked in order:
+#   detectors: (template, next state) pairs, the first one found wins
+#   confirm:   template that must stay visible, the state is dropped to unknown without it
+#   max_seconds: time after which the state is re-detected from scratch
+# States without templates are entered by the bot's own actions through enter().
+STATES = {
+    UNKNOWN: {
+        'detectors': [
+            (IN_BATTLE_TEMPLATE, 'battle'),
+            (CLOSE_BATTLE_TEMPLATE, 'battle_result'),
+            (STUCK_TEMPLATE, 'stuck_dialog'),
+            (BUY_COINS_TEMPLATE, 'buy_coins_modal'),
+            (MENU_TEMPLATE, 'menu'),
+        ],
+        'transitions': ['battle', 'battle_result', 'stuck_dialog', 'buy_coins_modal', 'menu'],
+    },
+    'menu': {
+        'detectors': [(IN_BATTLE_TEMPLATE, 'battle'), (STUCK_TEMPLATE, 'stuck_dialog')],
+        'confirm': MENU_TEMPLATE,
+        'transitions': ['battle', 'stuck_dialog', 'upgrade_panel', UNKNOWN],
+    },
+    'upgrade_panel': {
+        'detectors': [(BUY_COINS_TEMPLATE, 'buy_coins_modal')],
+        'max_seconds': 10,
+        'transitions': ['evolution_tab', 'buy_coins_modal', 'menu', UNKNOWN],
+    },
+    'evolution_tab': {
+        'detectors': [(BUY_COINS_TEMPLATE, 'buy_coins_modal')],
+        'max_seconds': 10,
+        'transitions': ['upgrade_panel', 'buy_coins_modal', 'menu', UNKNOWN],
+    },
+    'buy_coins_modal': {
+        'confirm': BUY_COINS_TEMPLATE,
+        'transitions': ['upgrade_panel', 'evolution_tab', 'menu', UNKNOWN],
+    },
+    'battle': {
+        'detectors': [(CLOSE_BATTLE_TEMPLATE, 'battle_result')],
+        'confirm': IN_BATTLE_TEMPLATE,
+        'max_seconds': 600,
+        'transitions': ['battle_result', UNKNOWN],
+    },
+    'battle_result': {
+        'detectors': [(MENU_TEMPLATE, 'menu'), (STUCK_TEMPLATE, 'stuck_dialog')],
+        'confirm': CLOSE_BATTLE_TEMPLATE,
+        'transitions': ['menu', 'stuck_dialog', UNKNOWN],
+    },
+    'stuck_dialog': {
+        'detectors': [(MENU_TEMPLATE, 'menu'), (IN_BATTLE_TEMPLATE, 'battle')],
+        'confirm': STUCK_TEMPLATE,
+        'transitions': ['menu', 'battle', UNKNOWN],
+    },
+}
+
+
+class ScreenStateMachine:
+    def __init__(self, find, states=STATES, on_transition=None, history=500, clock=time.monotonic):
+        # find(frame, template) returns the template's center on the frame or None
+        self.find = find
+        self.clock = clock
+        self.states = states
+        self.on_transition = on_transition
+        self.state = UNKNOWN
+        self.entered_at = clock()
+        # Where each template was last found, for handlers that need to tap it
+        self.last_matches = {}
+        self.transitions = deque(maxlen=history)
+        self.time_in_state = defaultdict(float)
+        self.templates_evaluated = 0
+        self.ticks = 0
+
+    def set_clock(self, clock):
+        self.entered_at = clock() - (self.clock() - self.entered_at)
+        self.clock = clock
+
+    def _find(self, frame, template):
+        self.templates_evaluated += 1
+        center = self.find(frame, template)
+        if center is not None:
+            self.last_matches[template] = center
+        return center
+
+    def candidates(self):
+        # Templates tick() can look for in the current state, in the order it checks them
+        spec = self.states[self.state]
+        templates = [template for template, _ in spec.get('detectors', [])]
+        if spec.get('confirm') and spec['confirm'] not in templates:
+            templates.append(spec['confirm'])
+        return templates
+
+    def tick(self, frame):
+        if frame is None:
+            return self.state
+
+        self.ticks += 1
+        spec = self.states[self.state]
+        for template, next_state in spec.get('detectors', []):
+            if self._find(frame, template) is not None:
+                self.enter(next_state, f"found {template}")
+                return self.state
+
+        confirm = spec.get('confirm')
+        if confirm and self._find(frame, confirm) is None:
+            self.enter(UNKNOWN, f"lost {confirm}")
+        elif spec.get('max_seconds') and self.clock() - self.entered_at > spec['max_seconds']:
+            self.enter(UNKNOWN, "timed out")
+        return self.state
+
+    def enter(self, state, reason='action'):
+        if state == self.state:
+            return
+        if state not in self.states[self.state]['transitions']:
+            raise InvalidTransition(f"Transition {self.state} -> {state} is not declared")
+        self._switch(state, reason)
+
+    def reset(self, reason='reset'):
+        # Back to unknown from any state, for recovering from a flow the table does not declare
+        if self.state != UNKNOWN:
+            self._switch(UNKNOWN, reason)
+
+    def _switch(self, state, reason):
+        now = self.clock()
+        self.time_in_state[self.state] += now - self.entered_at
+        self.transitions.append((time.time(), self.state, state, reason))
+        previous, self.state, self.entered_at = self.state, state, now
+        if self.on_transition:
+            self.on_transition(previous, state)
+
+    def templates_per_tick(self):
+        return self.templates_evaluated / self.ticks if self.ticks else 0.0
+
+    def time_summary(self):
+        summary = dict(self.time_in_state)
+        summary[self.state] = summary.get(self.state, 0.0) + self.clock() - self.entered_at
+        return summary
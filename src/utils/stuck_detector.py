@@ -0,0 +1,55 @@
+import threading
+
+import cv2 as cv
+import numpy as np
+
+# Thumbnails are (width, height); 1080x2316 screens shrink by ~30x per side
+THUMBNAIL_SIZE = (36, 78)
+
+
+class StuckDetector:
+    def __init__(self, min_frames=50, min_seconds=10.0, max_mean_diff=2.0, thumbnail_size=THUMBNAIL_SIZE):
+        self.min_frames = min_frames
+        self.min_seconds = min_seconds
+        self.max_mean_diff = max_mean_diff
+        self.thumbnail_size = thumbnail_size
+
+        # Preallocated, so an update allocates nothing; frames arrive from the capture, main and
+        # pipeline collector threads, the lock keeps the anchor and the run length consistent
+        width, height = thumbnail_size
+        self.thumbnail = np.zeros((height, width), dtype=np.uint8)
+        self.anchor = np.zeros((height, width), dtype=np.uint8)
+        self.anchor_time = None
+        self.unchanged_frames = 0
+        self.last_time = None
+        self.lock = threading.Lock()
+
+    def update(self, gray, timestamp):
+        with self.lock:
+            thumbnail = self.thumbnail
+            cv.resize(gray, self.thumbnail_size, dst=thumbnail, interpolation=cv.INTER_AREA)
+            self.last_time = timestamp
+
+            # Compare against the first frame of the current unchanged run rather than
+            # the previous frame, so a slow drift still counts as a change eventually
+            if self.anchor_time is not None and cv.norm(thumbnail, self.anchor, cv.NORM_L1) / thumbnail.size <= self.max_mean_diff:
+                self.unchanged_frames += 1
+                return
+
+            self.anchor[:] = thumbnail
+            self.anchor_time = timestamp
+            self.unchanged_frames = 0
+
+    def unchanged_seconds(self):
+        if self.anchor_time is None:
+            return 0.0
+        return self.last_time - self.anchor_time
+
+    def is_stuck(self):
+        with self.lock:
+            return self.unchanged_frames + 1 >= self.min_frames and self.unchanged_seconds() >= self.min_seconds
+
+    def reset(self):
+        with self.lock:
+            self.anchor_time = None
+            self.unchanged_frames = 0
@@ -0,0 +1,75 @@
+import threading
+import time
+
+
+class TapScheduler:
+    # One thread for the life of the bot, resumed by start() and paused by stop(), so battles
+    # never leave a second spawn thread tapping next to the first
+    def __init__(self, input_driver, targets, rate=10.0, should_continue=None):
+        # targets() is asked before every tap so pattern or unit changes apply immediately
+        self.input_driver = input_driver
+        self.targets = targets
+        self.rate = rate
+        self.should_continue = should_continue or (lambda: True)
+        self.active = threading.Event()
+        self.wakeup = threading.Event()
+        self.closed = False
+        # Held for the duration of every tap, stop() takes it to know no tap is still running
+        self.tap_lock = threading.Lock()
+        self.thread = None
+        self.taps_sent = 0
+
+    @property
+    def running(self):
+        return self.active.is_set()
+
+    def start(self):
+        if self.closed:
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.active.set()
+
+    def stop(self):
+        self.active.clear()
+        self.wakeup.set()
+        # Returns once the tap in progress, if any, has run on the device
+        if self.thread is not None and self.thread is not threading.current_thread():
+            with self.tap_lock:
+                pass
+
+    def close(self):
+        self.closed = True
+        self.stop()
+        self.active.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        interval = 1.0 / self.rate
+        index = 0
+        while True:
+            self.active.wait()
+            if self.closed:
+                return
+
+            next_tap = time.monotonic()
+            while self.active.is_set() and not self.closed:
+                # should_continue() only skips taps; stopping is left to stop() so a start()
+                # racing with the end of a battle is never lost
+                targets = self.targets() if self.should_continue() else None
+                with self.tap_lock:
+                    if targets and self.active.is_set():
+                        target = targets[index % len(targets)]
+                        # Returns once the device ran the tap, so nothing is left queued on it after stop()
+                        self.input_driver.tap(target['x'], target['y'])
+                        self.taps_sent += 1
+                        index += 1
+
+                # Schedule against a fixed timeline so slow taps don't lower the rate,
+                # but don't burst to catch up after a long stall
+                next_tap = max(next_tap + interval, time.monotonic())
+                self.wakeup.wait(next_tap - time.monotonic())
+                self.wakeup.clear()
@@ -0,0 +1,114 @@
+import glob
+import os
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2 as cv
+import numpy as np
+
+from utils.get_image_path import get_images_dir
+
+DEFAULT_MATCH_THRESHOLD = 0.7
+DOWNSCALE_FACTOR = 4
+
+# Per-template overrides, anything not listed here uses the defaults.
+# Regions are (left, top, right, bottom) like the OCR regions in main.py and are
+# clipped to the frame, so they are kept loose enough for 2316 and 2400 high screens.
+TEMPLATE_METADATA = {
+    'market-menu-button.png': {'region': (600, 1700, 1080, 2400)},
+    'start-battle-button.png': {'region': (0, 1000, 1080, 2000)},
+    'start-battle-brown-button.png': {'region': (0, 1000, 1080, 2000)},
+    # Close buttons sit on the top right corner of a dialog centred on screen, so never left of
+    # the middle nor below it; the bounds leave room for small dialogs and wider screens
+    'close_buy_coins.png': {'region': (400, 0, 1080, 1400)},
+    'are-you-stuck-button.png': {'region': (400, 0, 1080, 1400)},
+}
+
+
+def attach_shared_memory(name):
+    # Attaching registers the block with this process's resource tracker as if it had been created
+    # here. Children started by multiprocessing share their parent's tracker, where the block is
+    # already the owner's; a tracker of our own would unlink it under the owner when we exit, so the
+    # registration is taken back and only the creator ever unlinks it
+    own_tracker = resource_tracker._resource_tracker._fd is None
+    block = shared_memory.SharedMemory(name=name)
+    if own_tracker:
+        resource_tracker.unregister(block._name, 'shared_memory')
+    return block
+
+
+class Template:
+    def __init__(self, name, gray, threshold=DEFAULT_MATCH_THRESHOLD, downscale=DOWNSCALE_FACTOR, region=None):
+        self.metadata = {'threshold': threshold, 'downscale': downscale, 'region': region}
+        self.name = name
+        self.gray = gray
+        self.threshold = threshold
+        self.region = region
+        self.height, self.width = gray.shape[:2]
+        self.center_offset = (self.width // 2, self.height // 2)
+        self.downscale = downscale
+        self.small = cv.resize(gray, (max(1, self.width // downscale), max(1, self.height // downscale)),
+                               interpolation=cv.INTER_AREA)
+
+    def center(self, location):
+        return {'x': location[0] + self.center_offset[0], 'y': location[1] + self.center_offset[1]}
+
+
+class TemplateRegistry:
+    def __init__(self, templates=None):
+        self.templates = dict(templates or {})
+
+    @classmethod
+    def load(cls, directory=None, metadata=None):
+        directory = directory or get_images_dir()
+        metadata = TEMPLATE_METADATA if metadata is None else metadata
+
+        templates = {}
+        for path in sorted(glob.glob(os.path.join(directory, '*.png'))):
+            name = os.path.basename(path)
+            gray = cv.imread(path, cv.IMREAD_GRAYSCALE)
+            if gray is None:
+                raise ValueError(f"Could not read template {path}")
+            templates[name] = Template(name, gray, **metadata.get(name, {}))
+        return cls(templates)
+
+    def get(self, name):
+        if name not in self.templates:
+            raise KeyError(f"Unknown template '{name}'")
+        return self.templates[name]
+
+    def __contains__(self, name):
+        return name in self.templates
+
+    def __iter__(self):
+        return iter(self.templates.values())
+
+    def names(self):
+        return list(self.templates)
+
+    def export_shared(self):
+        # Packs every grayscale template into one shared memory block; the returned
+        # manifest is small and picklable, so worker processes can map the pixels
+        # read-only instead of each loading and holding their own copy
+        size = sum(template.gray.nbytes for template in self)
+        block = shared_memory.SharedMemory(create=True, size=max(1, size))
+        manifest = []
+        offset = 0
+        for template in self:
+            gray = np.ascontiguousarray(template.gray)
+            block.buf[offset:offset + gray.nbytes] = gray.tobytes()
+            manifest.append((template.name, offset, gray.shape, template.metadata))
+            offset += gray.nbytes
+        return block, manifest
+
+    @classmethod
+    def from_shared(cls, block_name, manifest):
+        block = attach_shared_memory(block_name)
+        templates = {}
+        for name, offset, shape, metadata in manifest:
+            gray = np.ndarray(shape, dtype=np.uint8, buffer=block.buf, offset=offset)
+            gray.flags.writeable = False
+            templates[name] = Template(name, gray, **metadata)
+        registry = cls(templates)
+        # Keeps the mapping alive for as long as the views are in use
+        registry.shared_block = block
+        return registry
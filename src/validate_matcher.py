@@ -0,0 +1,49 @@
+import argparse
+import glob
+import os
+import time
+
+import cv2 as cv
+
+from utils.matcher import TemplateMatcher
+from utils.templates import TemplateRegistry
+
+
+def main():
+    repo_root = os.path.join(os.path.dirname(__file__), '..')
+    parser = argparse.ArgumentParser(description="Check that the pyramid matcher makes the same decisions as a full scale search")
+    parser.add_argument('screenshots', nargs='*', default=sorted(glob.glob(os.path.join(repo_root, '*screen*.png'))))
+    args = parser.parse_args()
+
+    registry = TemplateRegistry.load()
+    mismatches = 0
+    for path in args.screenshots:
+        mat = cv.imread(path, cv.IMREAD_GRAYSCALE)
+        if mat is None:
+            print(f"Skipping unreadable {path}")
+            continue
+
+        # Fresh matchers per screenshot so the learned locations don't hide the search being validated
+        exhaustive = TemplateMatcher(registry, use_pyramid=False)
+        pyramid = TemplateMatcher(registry, use_pyramid=True)
+        for template in registry:
+            start = time.perf_counter()
+            expected, expected_score = exhaustive.match(mat, template.name)
+            exhaustive_ms = 1000 * (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            actual, actual_score = pyramid.match(mat, template.name)
+            pyramid_ms = 1000 * (time.perf_counter() - start)
+
+            same = (expected is None) == (actual is None)
+            if not same:
+                mismatches += 1
+            print(f"{'ok  ' if same else 'DIFF'} {os.path.basename(path)} {template.name}: "
+                  f"full {expected_score:.3f} {exhaustive_ms:.1f} ms, pyramid {actual_score:.3f} {pyramid_ms:.1f} ms")
+
+    print(f"{mismatches} decision(s) differ")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())